@@ -0,0 +1,74 @@
+"""
+Бенчмарк фильтра ключевых слов: KeywordMatcher против старого цикла
+    any(k.lower() in text.lower() for k in keywords)
+
+Запуск:
+    python bench_keywords.py [--messages 50000] [--json]
+"""
+
+import argparse
+import json
+import random
+import time
+
+from tgparse_pro import KeywordMatcher
+
+WORDS = [
+    "цена", "купить", "продам", "доставка", "скидка", "вопрос", "помогите", "кто",
+    "знает", "где", "работа", "вакансия", "резюме", "ищу", "срочно", "москва",
+    "hello", "price", "sale", "order", "shipping", "telegram", "бот", "канал",
+]
+
+def make_texts(n: int, seed: int = 1) -> list:
+    rnd = random.Random(seed)
+    return [" ".join(rnd.choice(WORDS) + rnd.choice(["", "ы", "а", "!"]) for _ in range(rnd.randint(3, 40)))
+            for _ in range(n)]
+
+def make_keywords(n: int, seed: int = 2) -> list:
+    rnd = random.Random(seed)
+    # Реалистичный словарь: немного «живых» слов и много промахов
+    alphabet = "абвгдежзиклмнопрстуфхцчшщэюя"
+    out = rnd.sample(WORDS, min(3, n))
+    while len(out) < n:
+        out.append("".join(rnd.choice(alphabet) for _ in range(rnd.randint(4, 9))))
+    return out
+
+def old_loop(texts, keywords):
+    return sum(1 for text in texts if any(k.lower() in text.lower() for k in keywords))
+
+def matcher(texts, keywords):
+    m = KeywordMatcher(keywords)
+    return sum(1 for text in texts if m.match(text))
+
+def bench(fn, texts, keywords) -> tuple:
+    t = time.perf_counter()
+    hits = fn(texts, keywords)
+    return hits, time.perf_counter() - t
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--messages", type=int, default=50000)
+    ap.add_argument("--sizes", default="1,10,100,1000")
+    ap.add_argument("--json", action="store_true", help="вывести результаты в JSON")
+    args = ap.parse_args()
+
+    texts = make_texts(args.messages)
+    results = []
+    for size in map(int, args.sizes.split(",")):
+        keywords = make_keywords(size)
+        old_hits, old_t = bench(old_loop, texts, keywords)
+        new_hits, new_t = bench(matcher, texts, keywords)
+        assert old_hits == new_hits, (size, old_hits, new_hits)
+        results.append({"keywords": size, "messages": len(texts), "hits": new_hits,
+                        "old_s": round(old_t, 4), "matcher_s": round(new_t, 4),
+                        "speedup": round(old_t / new_t, 1) if new_t else None})
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+        return
+    print(f"{'слов':>6} {'совпадений':>11} {'старый, с':>10} {'matcher, с':>11} {'ускорение':>10}")
+    for r in results:
+        print(f"{r['keywords']:>6} {r['hits']:>11} {r['old_s']:>10} {r['matcher_s']:>11} {r['speedup']:>9}x")
+
+if __name__ == "__main__":
+    main()
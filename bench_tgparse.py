@@ -0,0 +1,388 @@
+"""
+Офлайн-бенчмарк TGParse PRO: поддельный TelegramClient вместо аккаунта и сети.
+
+Что меряется:
+    parse    — parse_messages: холодный прогон (всё из «Telegram») и повторный (из хранилища)
+    senders  — разрешение отправителей: пустой кэш, только БД, память
+    export   — рендеринг всех форматов из EXPORT_FORMATS
+    db       — задержка хелперов БД (тариф, db_log_parse, /admin, /account)
+    flow     — задача /parse целиком (run_parse_job): N чатов параллельно + экспорт
+
+История синтетическая: размер, число отправителей, доля min-сущностей (без
+данных отправителя в пачке), длина текста, задержка страницы и FloodWait на
+каждом N-м запросе задаются флагами. База — временный файл, tgparse.db не
+трогается. Остальные настройки бота (PARSE_SLICES, PARSE_CONCURRENCY, ...)
+берутся из тех же переменных окружения, что и в проде.
+
+Запуск:
+    python bench_tgparse.py [--rows 100,1000,10000,50000] [--chats 1,5,20]
+                            [--latency 0.02] [--flood-every 0] [--only parse,export]
+                            [--json results.json]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from datetime import datetime, timezone, timedelta
+
+from telethon.errors import FloodWaitError
+from telethon.tl.types import Channel, User
+
+import tgparse_pro as tp
+
+WORDS = [
+    "цена", "купить", "продам", "доставка", "скидка", "вопрос", "помогите", "кто",
+    "знает", "где", "работа", "вакансия", "резюме", "ищу", "срочно", "москва",
+    "hello", "price", "sale", "order", "shipping", "telegram", "бот", "канал",
+]
+
+# ─── Поддельный Telegram ─────────────────────────────────────────────────────
+class FakeMessage:
+    __slots__ = ("id", "date", "text", "sender_id", "sender", "_client")
+
+    def __init__(self, client, id, date, text, sender_id, sender):
+        self._client = client
+        self.id, self.date, self.text = id, date, text
+        self.sender_id, self.sender = sender_id, sender
+
+    async def get_sender(self):
+        await self._client.request()
+        return self._client.users[self.sender_id]
+
+class FakeTelegramClient:
+    """Подмена TelegramClient для parse_messages: те же методы и аргументы, история в памяти.
+
+    Каждая страница iter_messages и каждый get_messages/get_sender — один
+    «запрос» с задержкой latency; каждый flood_every-й запрос вместо ответа
+    бросает FloodWaitError на flood_seconds.
+    """
+
+    def __init__(self, rows: int, senders: int = 500, min_share: float = 0.1, text_len: int = 120,
+                 latency: float = 0.02, page: int = 100, flood_every: int = 0, flood_seconds: int = 1,
+                 seed: int = 1):
+        self.latency, self.page = latency, page
+        self.flood_every, self.flood_seconds = flood_every, flood_seconds
+        self.requests = self.fetched = self.floods = 0
+        self._entities = {}
+        self._rnd = random.Random(seed)
+        self._rows, self._senders, self._min_share, self._text_len = rows, senders, min_share, text_len
+        self.users = {i: User(id=i, first_name=f"Имя{i}", last_name=None,
+                              username=f"user{i}" if i % 3 else None)
+                      for i in range(1, senders + 1)}
+        self._min_users = {i: User(id=i, min=True, first_name=f"Имя{i}") for i in self.users}
+        self.histories = {}
+
+    def _history(self, peer_id: int) -> list:
+        if peer_id not in self.histories:
+            rnd, now = self._rnd, datetime.now(timezone.utc)
+            step = timedelta(days=90) / max(self._rows, 1)
+            weights = [1 / i for i in range(1, self._senders + 1)]   # «болтливые» и молчуны, как в живых чатах
+            ids = rnd.choices(range(1, self._senders + 1), weights=weights, k=self._rows)
+            msgs = []
+            for i, uid in enumerate(ids, 1):
+                text = ""
+                if rnd.random() > 0.05:   # 5% служебных сообщений без текста
+                    n = max(1, int(rnd.expovariate(1 / self._text_len)) // 7)
+                    text = " ".join(rnd.choice(WORDS) for _ in range(n))
+                sender = self._min_users[uid] if rnd.random() < self._min_share else self.users[uid]
+                msgs.append(FakeMessage(self, i, now - step * (self._rows - i), text, uid, sender))
+            self.histories[peer_id] = msgs
+        return self.histories[peer_id]
+
+    async def request(self):
+        self.requests += 1
+        if self.flood_every and self.requests % self.flood_every == 0:
+            self.floods += 1
+            raise FloodWaitError(request=None, capture=self.flood_seconds)
+        await asyncio.sleep(self.latency)
+
+    def is_connected(self):
+        return True
+
+    async def get_entity(self, chat):
+        await self.request()
+        if chat not in self._entities:
+            self._entities[chat] = Channel(id=1000 + len(self._entities), title=f"Чат {chat}", photo=None,
+                                           date=datetime.now(timezone.utc), access_hash=1)
+        return self._entities[chat]
+
+    async def get_input_entity(self, peer):
+        # Как кэш сессии Telethon: без запроса, только уже полученные через get_entity
+        for entity in self._entities.values():
+            if tp.tl_utils.get_peer_id(entity) == peer:
+                return entity
+        raise ValueError(f"Could not find the input entity for {peer}")
+
+    async def get_messages(self, entity, limit=1, offset_date=None, **kwargs):
+        await self.request()
+        msgs = self._history(entity.id)
+        if offset_date is not None:
+            msgs = [m for m in msgs if m.date < offset_date]
+        return list(reversed(msgs[-limit:])) if limit else list(reversed(msgs))
+
+    async def iter_messages(self, entity, limit=None, reverse=False, min_id=0, max_id=0, search=None, **kwargs):
+        msgs = self._history(entity.id)
+        lo = max(min_id, 0)                                        # id == индекс + 1
+        hi = min(max_id - 1, len(msgs)) if max_id else len(msgs)
+        window = msgs[lo:hi] if reverse else msgs[lo:hi][::-1]
+        if search:
+            window = [m for m in window if search.lower() in m.text.lower()]
+        if limit is not None:
+            window = window[:limit]
+        for start in range(0, len(window), self.page):
+            await self.request()
+            for msg in window[start:start + self.page]:
+                self.fetched += 1
+                yield msg
+
+class FakeMessageHandle:
+    def __init__(self, bot, document=None):
+        self.bot, self.document = bot, document
+
+    async def edit_text(self, text, **kwargs):
+        self.bot.edits += 1
+
+    async def delete(self):
+        pass
+
+class FakeBot:
+    def __init__(self):
+        self.edits = self.documents = self.bytes = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        return FakeMessageHandle(self)
+
+    async def send_document(self, chat_id, document, **kwargs):
+        # Строка — file_id уже загруженного файла: повторной загрузки нет
+        self.documents += 1
+        if not isinstance(document, str):
+            self.bytes += len(document.read())
+        return FakeMessageHandle(self, SimpleNamespace(file_id=f"file{self.documents}"))
+
+class FakeApp:
+    def __init__(self):
+        self.bot = FakeBot()
+
+# ─── Подготовка ──────────────────────────────────────────────────────────────
+async def reset_store():
+    await tp.db.execute("DELETE FROM store_messages")
+    await tp.db.execute("DELETE FROM store_ranges")
+    await tp.db.execute("DELETE FROM store_chats")
+    tp.store._ranges.clear()
+
+async def reset_senders(keep_db=False):
+    tp.senders = tp.SenderCache(tp.SENDER_CACHE_SIZE, tp.SENDER_CACHE_TTL)
+    if not keep_db:
+        await tp.db.execute("DELETE FROM senders")
+
+def client_for(args, rows: int) -> FakeTelegramClient:
+    # В истории берём с запасом: 5% служебных сообщений без текста в выгрузку не попадают
+    return FakeTelegramClient(int(rows * 1.1) + 10, senders=args.senders, min_share=args.min_share,
+                              text_len=args.text_len, latency=args.latency, page=args.page,
+                              flood_every=args.flood_every, flood_seconds=args.flood_seconds)
+
+def timed(t0: float) -> float:
+    return round(time.perf_counter() - t0, 4)
+
+# ─── Бенчмарки ───────────────────────────────────────────────────────────────
+async def bench_parse(args) -> list:
+    out = []
+    for rows in args.rows:
+        await reset_store(); await reset_senders()
+        client = client_for(args, rows)
+        for run in ("cold", "warm"):
+            req0, f0 = client.requests, client.fetched
+            t0 = time.perf_counter()
+            async with tp.pool.accounts[0].limiter:
+                spool = await tp.parse_messages(client, "bench", None, None, rows)
+            dt = timed(t0)
+            out.append({"bench": "parse", "run": run, "rows": len(spool), "seconds": dt,
+                        "msgs_per_s": round(len(spool) / dt) if dt else None,
+                        "requests": client.requests - req0, "fetched": client.fetched - f0,
+                        "flood_waits": client.floods})
+            spool.close()
+    return out
+
+async def bench_senders(args) -> list:
+    out = []
+    for rows in args.rows:
+        client = client_for(args, rows)
+        msgs = [m for m in client._history(1) if m.text][:rows]
+        for run, keep_db in (("cold", False), ("db", True), ("memory", None)):
+            if keep_db is not None:
+                await reset_senders(keep_db=keep_db)
+            tp.senders.stats = dict.fromkeys(tp.senders.stats, 0)
+            req0 = client.requests
+            t0 = time.perf_counter()
+            for msg in msgs:
+                await tp.senders.resolve(msg)
+            dt = timed(t0)
+            tp.senders.flush(); await tp.db.flush()
+            out.append({"bench": "senders", "run": run, "rows": len(msgs), "seconds": dt,
+                        "us_per_msg": round(dt / max(len(msgs), 1) * 1e6, 1),
+                        "network": client.requests - req0, **tp.senders.stats})
+    return out
+
+def make_spools(args, rows: int, chats: int = 1) -> list:
+    rnd, now = random.Random(3), datetime.now(timezone.utc)
+    spools = []
+    for c in range(chats):
+        spool = tp.RowSpool(f"Чат {c}")
+        for i in range(rows // chats):
+            n = max(1, int(rnd.expovariate(1 / args.text_len)) // 7)
+            spool.add(f"@user{rnd.randint(1, args.senders)}", " ".join(rnd.choice(WORDS) for _ in range(n)),
+                      now - timedelta(seconds=i * 37))
+        spools.append(spool)
+    return spools
+
+async def bench_export(args) -> list:
+    out = []
+    for rows in args.rows:
+        spools = make_spools(args, rows)
+        for fmt in tp.EXPORT_FORMATS:
+            t0 = time.perf_counter()
+            parts = await tp.render_export(spools, fmt)
+            dt = timed(t0)
+            size = sum(f.seek(0, 2) for f, _ in parts)
+            out.append({"bench": "export", "format": fmt, "rows": rows, "seconds": dt,
+                        "rows_per_s": round(rows / dt) if dt else None, "bytes": size, "parts": len(parts)})
+            for f, _ in parts: f.close()
+        for spool in spools: spool.close()
+    return out
+
+async def bench_db(args) -> list:
+    n = args.db_iterations
+    user_ids = list(range(1, n + 1))
+    for uid in user_ids:
+        tp.db_upsert_user(uid, f"user{uid}")
+    await tp.db_add_schedule(1, "@bench", 6)
+
+    async def measure(name, fn):
+        samples = []
+        for uid in user_ids:
+            t0 = time.perf_counter()
+            await fn(uid)
+            samples.append(time.perf_counter() - t0)
+        samples.sort()
+        return {"bench": "db", "op": name, "calls": n,
+                "mean_us": round(statistics.fmean(samples) * 1e6, 1),
+                "p95_us": round(samples[int(len(samples) * 0.95) - 1] * 1e6, 1)}
+
+    async def log_and_flush(uid):
+        tp.db_log_parse(uid, "@bench", 100)
+        await tp.db.flush()
+
+    return [
+        await measure("get_user_plan (miss)", lambda uid: tp.get_user_plan(uid + n)),
+        await measure("get_user_plan (hit)", lambda uid: tp.get_user_plan(uid + n)),
+        await measure("db_get_user", tp.db_get_user),
+        await measure("db_log_parse + flush", log_and_flush),
+        await measure("db_stats", lambda uid: tp.db_stats()),
+        await measure("db_daily_stats", lambda uid: tp.db_daily_stats(7)),
+        await measure("db_get_user_schedules", tp.db_get_user_schedules),
+        await measure("db_get_user_activity", tp.db_get_user_activity),
+    ]
+
+async def bench_flow(args) -> list:
+    out = []
+    rows = max(args.rows)
+    for chats in args.chats:
+        await reset_store(); await reset_senders()
+        client = client_for(args, rows // chats)
+        for account in tp.pool.accounts:
+            account.manager.client = client
+        job = {"id": 0, "user_id": 1, "chat_id": 1, "priority": 3, "params": {
+            "chats": [f"@chat{i}" for i in range(chats)], "date_from": None, "date_to": None,
+            "limit": rows // chats, "keywords": None, "fmt": args.flow_format, "period": "all"}}
+        # Второй прогон того же запроса отдаётся из кэша результатов
+        for run in ("fresh", "cached"):
+            app, req0 = FakeApp(), client.requests
+            t0 = time.perf_counter()
+            await tp.run_parse_job(app, job)
+            dt = timed(t0)
+            total = rows // chats * chats
+            out.append({"bench": "flow", "run": run, "chats": chats, "rows": total, "format": args.flow_format,
+                        "seconds": dt, "msgs_per_s": round(total / dt) if dt else None,
+                        "requests": client.requests - req0, "flood_waits": client.floods,
+                        "documents": app.bot.documents, "bytes": app.bot.bytes, "progress_edits": app.bot.edits})
+    return out
+
+BENCHES = {"parse": bench_parse, "senders": bench_senders, "export": bench_export,
+           "db": bench_db, "flow": bench_flow}
+
+# ─── Запуск ───────────────────────────────────────────────────────────────────
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+def print_table(results: list):
+    for r in results:
+        head = f"{r['bench']:<8}"
+        rest = "  ".join(f"{k}={v}" for k, v in r.items() if k != "bench")
+        print(f"{head} {rest}")
+
+async def run(args) -> list:
+    tp.db_init()
+    tp.db.start()
+    try:
+        results = []
+        for name in args.only:
+            print(f"▶ {name}...", file=sys.stderr)
+            results += await BENCHES[name](args)
+        return results
+    finally:
+        await tp.db.close()
+        tp.export_pool.shutdown(wait=True)
+
+def main():
+    ap = argparse.ArgumentParser()
+    ints = lambda s: [int(x) for x in s.split(",")]
+    ap.add_argument("--rows", type=ints, default=[100, 1000, 10000, 50000], help="размеры выгрузки")
+    ap.add_argument("--chats", type=ints, default=[1, 5, 20], help="число чатов для flow")
+    ap.add_argument("--senders", type=int, default=500, help="уникальных отправителей в чате")
+    ap.add_argument("--min-share", type=float, default=0.1, help="доля сообщений с min-отправителем")
+    ap.add_argument("--text-len", type=int, default=120, help="средняя длина текста, символов")
+    ap.add_argument("--latency", type=float, default=0.02, help="задержка одного запроса, сек")
+    ap.add_argument("--page", type=int, default=100, help="сообщений в странице iter_messages")
+    ap.add_argument("--flood-every", type=int, default=0, help="FloodWait на каждом N-м запросе (0 — нет)")
+    ap.add_argument("--flood-seconds", type=int, default=1)
+    ap.add_argument("--db-iterations", type=int, default=500)
+    ap.add_argument("--flow-format", default="excel", choices=list(tp.EXPORT_FORMATS))
+    ap.add_argument("--only", type=lambda s: s.split(","), default=list(BENCHES), help="parse,senders,export,db,flow")
+    ap.add_argument("--json", metavar="PATH", help="записать результаты в JSON (- — в stdout)")
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tp.db.path = os.path.join(tmp, "bench.db")
+        tp.result_cache.path = os.path.join(tmp, "result_cache")
+        results = asyncio.run(run(args))
+
+    report = {
+        "commit": git_commit(),
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "args": {k: v for k, v in vars(args).items() if k != "json"},
+        "results": results,
+    }
+    if args.json == "-":
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_table(results)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
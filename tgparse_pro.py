@@ -11,32 +11,56 @@ TGParse PRO — Коммерческий парсер с оплатой
   MAX   — 50000 сообщений, безлимит чатов + расписание, 400 Stars
 
 Установка:
-    pip install python-telegram-bot telethon pandas openpyxl python-dotenv apscheduler
+    pip install python-telegram-bot telethon openpyxl python-dotenv
 
 Запуск:
     python tgparse_pro.py
 """
 
 import asyncio
+import bisect
+import csv
+import gzip
+import functools
+import hashlib
 import io
+import itertools
+import json
 import logging
+import math
 import os
+import re
+import secrets
+import shutil
 import sqlite3
+import tempfile
+import threading
+import time
+import zipfile
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AbstractAsyncContextManager, asynccontextmanager, contextmanager
 from datetime import datetime, timezone, timedelta
-from typing import Optional
+from typing import NamedTuple, Optional
 
-import pandas as pd
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from dotenv import load_dotenv
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import PatternFill, Font, Alignment
+from openpyxl.utils import get_column_letter
 from telegram import (
     Update, InlineKeyboardButton, InlineKeyboardMarkup,
     LabeledPrice, ReplyKeyboardMarkup, KeyboardButton,
 )
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
 from telegram.ext import (
-    Application, CommandHandler, MessageHandler, CallbackQueryHandler,
+    Application, BaseUpdateProcessor, CommandHandler, MessageHandler, CallbackQueryHandler,
     ConversationHandler, PreCheckoutQueryHandler, ContextTypes, filters,
 )
-from telethon import TelegramClient
+from telethon import TelegramClient, utils as tl_utils
+from telethon.errors import BadRequestError, FloodWaitError
 from telethon.tl.types import User
 
 load_dotenv()
@@ -45,11 +69,235 @@ BOT_TOKEN = os.getenv("TG_BOT_TOKEN")
 API_ID    = int(os.getenv("TG_API_ID", "0"))
 API_HASH  = os.getenv("TG_API_HASH", "")
 SESSION   = os.getenv("TG_SESSION", "tgparse")
+TG_SESSIONS = os.getenv("TG_SESSIONS", SESSION)   # пул аккаунтов через запятую: session[:api_id:api_hash]
+TG_RECONNECT_TRIES = int(os.getenv("TG_RECONNECT_TRIES", "5"))
+PARSE_CONCURRENCY  = int(os.getenv("PARSE_CONCURRENCY", "4"))   # параллельных парсингов на аккаунт
+FLOOD_MAX_WAIT     = int(os.getenv("FLOOD_MAX_WAIT", "900"))     # дольше — отдаём ошибку пользователю
+FLOOD_FAILOVER_SEC = int(os.getenv("FLOOD_FAILOVER_SEC", "30"))  # с пулом аккаунтов: дольше — переезд на другой
+SPOOL_MEM_BYTES    = int(os.getenv("SPOOL_MEM_BYTES", str(4 * 1024 * 1024)))  # дальше строки уходят на диск
+EXPORT_WORKERS     = int(os.getenv("EXPORT_WORKERS", "2"))  # потоков для рендеринга xlsx/csv
+DB_FLUSH_INTERVAL  = float(os.getenv("DB_FLUSH_INTERVAL", "0.5"))  # сек между пакетными коммитами
+DB_BATCH_SIZE      = int(os.getenv("DB_BATCH_SIZE", "500"))
+SENDER_CACHE_SIZE  = int(os.getenv("SENDER_CACHE_SIZE", "20000"))
+SENDER_CACHE_TTL   = int(os.getenv("SENDER_CACHE_TTL", str(7 * 24 * 3600)))  # сек
+PLAN_CACHE_SIZE    = int(os.getenv("PLAN_CACHE_SIZE", "50000"))
+STORE_MAX_ROWS     = int(os.getenv("STORE_MAX_ROWS", "100000"))  # сообщений на чат в локальном хранилище
+STORE_MAX_CHATS    = int(os.getenv("STORE_MAX_CHATS", "500"))
+STORE_TTL_DAYS     = int(os.getenv("STORE_TTL_DAYS", "30"))      # чат без обращений дольше — удаляется
+PARSE_CHECKPOINT   = int(os.getenv("PARSE_CHECKPOINT", "1000"))  # сообщений между сохранениями прогресса
+PARSE_SLICES       = int(os.getenv("PARSE_SLICES", "4"))         # параллельных срезов id одного большого чата
+PARSE_SLICE_IDS    = int(os.getenv("PARSE_SLICE_IDS", "2000"))   # id в одном срезе
+PARSE_SLICE_MIN    = int(os.getenv("PARSE_SLICE_MIN", "10000"))  # с какого лимита включать срезы
+SCHEDULE_CONCURRENCY = int(os.getenv("SCHEDULE_CONCURRENCY", "2"))  # одновременных автопарсингов
+SCHEDULE_RETRY_MIN   = int(os.getenv("SCHEDULE_RETRY_MIN", "30"))    # повтор упавшего расписания
+EXPORT_PART_BYTES    = int(os.getenv("EXPORT_PART_BYTES", str(45 * 1024 * 1024)))  # больше — файл режется на части (лимит бота 50 МБ)
+PROGRESS_INTERVAL    = float(os.getenv("PROGRESS_INTERVAL", "3"))    # сек между правками сообщения о прогрессе
+JOB_WORKERS          = int(os.getenv("JOB_WORKERS", "3"))            # задач /parse, выполняемых одновременно
+PARSE_LOG_DAYS       = int(os.getenv("PARSE_LOG_DAYS", "90"))        # сырые записи parse_log старше — удаляются
+CHAT_CACHE_TTL       = int(os.getenv("CHAT_CACHE_TTL", str(7 * 24 * 3600)))  # сек: сколько верим найденному чату
+CHAT_MISS_TTL        = int(os.getenv("CHAT_MISS_TTL", "3600"))       # сек: сколько помним, что чата нет
+CHAT_CHECK_TIMEOUT   = float(os.getenv("CHAT_CHECK_TIMEOUT", "5"))   # сек на проверку чата в диалоге
+CHAT_CHECK_CONCURRENCY = int(os.getenv("CHAT_CHECK_CONCURRENCY", "2"))  # одновременных проверок через сеть на весь бот
+CHAT_CHECK_MAX       = int(os.getenv("CHAT_CHECK_MAX", "10"))        # чатов больше — в диалоге проверяем только по кэшу
+CHAT_CACHE_SIZE      = int(os.getenv("CHAT_CACHE_SIZE", "20000"))    # чатов в памяти
+RESULT_CACHE_DIR     = os.getenv("RESULT_CACHE_DIR", "result_cache")
+RESULT_CACHE_BYTES   = int(os.getenv("RESULT_CACHE_BYTES", str(500 * 1024 * 1024)))  # больше — вытесняем давно не нужные
+RESULT_CACHE_TTL     = int(os.getenv("RESULT_CACHE_TTL", "600"))     # сек: повтор того же запроса отдаётся готовым файлом
+METRICS_HOST         = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT         = int(os.getenv("METRICS_PORT", "0"))            # 0 — HTTP-эндпоинт метрик выключен
+BOT_MODE             = os.getenv("BOT_MODE", "polling")               # polling | webhook
+BOT_API_URL          = os.getenv("BOT_API_URL", "https://api.telegram.org").rstrip("/")  # свой Bot API или фейк для тестов
+UPDATE_CONCURRENCY   = int(os.getenv("UPDATE_CONCURRENCY", "16"))    # обновлений параллельно (от одного пользователя — по очереди)
+WEBHOOK_URL          = os.getenv("WEBHOOK_URL", "")                   # публичный https-адрес; пусто — домен Railway
+WEBHOOK_LISTEN       = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT         = int(os.getenv("PORT", "8443"))                 # Railway передаёт порт в PORT
+WEBHOOK_PATH         = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET       = os.getenv("WEBHOOK_SECRET", "")                # пусто — новый случайный при каждом запуске
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))  # одновременных запросов от Telegram
 ADMIN_ID  = int(os.getenv("ADMIN_ID", "0"))  # Твой Telegram ID для статистики
 
 logging.basicConfig(format="%(asctime)s | %(levelname)s | %(message)s", level=logging.INFO)
 log = logging.getLogger(__name__)
 
+# ─── Метрики ─────────────────────────────────────────────────────────────────
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+RATE_BUCKETS    = (10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 50000)
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)   # последняя ячейка — +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        # Верхняя граница корзины, в которую попал q-й процентиль — для сводки этого хватает
+        seen, need = 0, q * self.count
+        for bound, n in zip((*self.buckets, math.inf), self.counts):
+            seen += n
+            if seen >= need:
+                return bound if bound != math.inf else self.buckets[-1]
+        return 0.0
+
+class Metrics:
+    """Счётчики, гистограммы и gauge-функции процесса.
+
+    Отдаются в текстовом формате Prometheus (METRICS_PORT) и сводкой в
+    /admin metrics. Новые горячие места размечаются через timer() / timed(),
+    без ручного perf_counter.
+    """
+
+    def __init__(self):
+        self.counters: dict[tuple, float] = {}
+        self.histograms: dict[tuple, Histogram] = {}
+        self.gauges: dict[tuple, callable] = {}
+        self.help: dict[str, str] = {}
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, buckets=LATENCY_BUCKETS, **labels):
+        key = self._key(name, labels)
+        hist = self.histograms.get(key)
+        if hist is None:
+            hist = self.histograms[key] = Histogram(buckets)
+        hist.observe(value)
+
+    def gauge(self, name: str, fn, help: str = "", **labels):
+        self.gauges[self._key(name, labels)] = fn
+        if help: self.help[name] = help
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t, **labels)
+
+    def timed(self, name: str, **labels):
+        def wrap(fn):
+            if asyncio.iscoroutinefunction(fn):
+                @functools.wraps(fn)
+                async def async_wrapper(*args, **kwargs):
+                    with self.timer(name, **labels):
+                        return await fn(*args, **kwargs)
+                return async_wrapper
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return wrap
+
+    async def timed_iter(self, aiter, name: str, **labels):
+        # Время ожидания каждого элемента; сообщения из уже полученной страницы приходят
+        # мгновенно, поэтому в гистограмму попадают только настоящие запросы (> 1 мс)
+        it = aiter.__aiter__()
+        while True:
+            t = time.perf_counter()
+            try:
+                item = await it.__anext__()
+            except StopAsyncIteration:
+                return
+            finally:
+                waited = time.perf_counter() - t
+                self.inc(f"{name}_total", waited, **labels)
+                if waited > 0.001:
+                    self.observe(name, waited, **labels)
+            yield item
+
+    @staticmethod
+    def _labels(labels: tuple, extra: str = "") -> str:
+        parts = [f'{k}="{v}"' for k, v in labels]
+        if extra: parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> str:
+        lines, typed = [], set()
+
+        def head(name, kind):
+            if name not in typed:
+                typed.add(name)
+                if name in self.help: lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(self.counters.items()):
+            head(name, "counter")
+            lines.append(f"{name}{self._labels(labels)} {value:g}")
+        for (name, labels), fn in sorted(self.gauges.items(), key=lambda kv: kv[0]):
+            try: value = fn()
+            except Exception: continue
+            head(name, "gauge")
+            lines.append(f"{name}{self._labels(labels)} {value:g}")
+        for (name, labels), h in sorted(self.histograms.items(), key=lambda kv: kv[0]):
+            head(name, "histogram")
+            cum = 0
+            for bound, n in zip((*h.buckets, "+Inf"), h.counts):
+                cum += n
+                le = f'le="{bound}"'
+                lines.append(f"{name}_bucket{self._labels(labels, le)} {cum}")
+            lines.append(f"{name}_sum{self._labels(labels)} {h.sum:g}")
+            lines.append(f"{name}_count{self._labels(labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        # Коротко для /admin metrics: гистограммы — n / среднее / p95, остальное — значения
+        out = []
+        for (name, labels), h in sorted(self.histograms.items(), key=lambda kv: kv[0]):
+            if h.count:
+                out.append(f"{name}{self._labels(labels)}: n={h.count} avg={h.sum / h.count:.3g} p95≤{h.quantile(0.95):g}")
+        for (name, labels), value in sorted(self.counters.items()):
+            out.append(f"{name}{self._labels(labels)}: {value:,.6g}")
+        for (name, labels), fn in sorted(self.gauges.items(), key=lambda kv: kv[0]):
+            try: out.append(f"{name}{self._labels(labels)}: {fn():,.6g}")
+            except Exception: pass
+        return "\n".join(out)
+
+metrics = Metrics()
+
+async def serve_metrics(host: str, port: int):
+    async def handle(reader, writer):
+        try:
+            await reader.readuntil(b"\r\n\r\n")
+            body = metrics.render().encode()
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         b"Content-Length: " + str(len(body)).encode() + b"\r\nConnection: close\r\n\r\n" + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+    server = await asyncio.start_server(handle, host, port)
+    log.info(f"Metrics on http://{host}:{port}/metrics")
+    return server
+
+async def loop_lag_monitor(interval: float = 1.0):
+    # На сколько позже положенного просыпается sleep — столько event loop был занят чем-то синхронным
+    while True:
+        t = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag = time.perf_counter() - t - interval
+        metrics.observe("tgparse_event_loop_lag_seconds", max(lag, 0.0))
+
+class TimedRequest(HTTPXRequest):
+    """HTTPXRequest бота с замером каждого вызова Bot API (long polling идёт отдельным запросом)."""
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        with metrics.timer("tgparse_bot_api_seconds", method=url.rsplit("/", 1)[-1]):
+            return await super().do_request(url, method, request_data, **kwargs)
+
 # ─── Тарифы ──────────────────────────────────────────────────────────────────
 PLANS = {
     "free": {
@@ -58,6 +306,7 @@ PLANS = {
         "msg_limit": 100,
         "chat_limit": 1,
         "scheduler": False,
+        "priority": 0,          # место в очереди задач
         "description": "100 сообщений, 1 чат",
     },
     "basic": {
@@ -66,6 +315,7 @@ PLANS = {
         "msg_limit": 1000,
         "chat_limit": 3,
         "scheduler": False,
+        "priority": 1,
         "description": "1 000 сообщений, 3 чата",
     },
     "pro": {
@@ -74,6 +324,7 @@ PLANS = {
         "msg_limit": 10000,
         "chat_limit": 10,
         "scheduler": True,
+        "priority": 2,
         "description": "10 000 сообщений, 10 чатов, автопарсинг",
     },
     "max": {
@@ -82,21 +333,135 @@ PLANS = {
         "msg_limit": 50000,
         "chat_limit": 999,
         "scheduler": True,
+        "priority": 3,
         "description": "50 000 сообщений, ∞ чатов, расписание",
     },
 }
 
 # ─── Состояния диалога ────────────────────────────────────────────────────────
 (WAIT_CHAT, WAIT_PERIOD, WAIT_LIMIT, WAIT_FORMAT,
- WAIT_SCHEDULE_CHAT, WAIT_SCHEDULE_INTERVAL) = range(6)
+ WAIT_SCHEDULE_CHAT, WAIT_SCHEDULE_INTERVAL, WAIT_KEYWORDS) = range(7)
 
 # ─── База данных ─────────────────────────────────────────────────────────────
 DB = "tgparse.db"
 
-def db_init():
-    con = sqlite3.connect(DB)
-    cur = con.cursor()
-    cur.executescript("""
+def iso_utc(dt: datetime) -> str:
+    # Один формат для next_run, чтобы строки сравнивались в SQL как даты
+    return dt.astimezone(timezone.utc).isoformat(timespec="seconds")
+
+class Database:
+    """Одно долгоживущее WAL-соединение в выделенном потоке.
+
+    Все запросы выполняются в этом потоке и не блокируют event loop. Частые
+    записи (defer) копятся в памяти и коммитятся одной транзакцией раз в
+    DB_FLUSH_INTERVAL или по DB_BATCH_SIZE; любое чтение сначала сбрасывает
+    очередь, так что свои записи всегда видны.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.con: Optional[sqlite3.Connection] = None
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+        self._pending: list[tuple[str, list]] = []
+        self._pending_lock = threading.Lock()
+        self._flusher: Optional[asyncio.Task] = None
+        self.stats = {"calls": 0, "time": 0.0, "batches": 0, "batched": 0}
+
+    def open(self):
+        con = sqlite3.connect(self.path, check_same_thread=False, cached_statements=256)
+        con.row_factory = sqlite3.Row
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=NORMAL")
+        con.execute("PRAGMA temp_store=MEMORY")
+        con.execute("PRAGMA cache_size=-16000")
+        con.execute("PRAGMA busy_timeout=5000")
+        self.con = con
+
+    def _call(self, fn, args):
+        t = time.perf_counter()
+        try:
+            self._flush()
+            return fn(self.con, *args)
+        finally:
+            self.stats["calls"] += 1
+            self.stats["time"] += time.perf_counter() - t
+
+    async def run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        # Замер на стороне event loop: вместе с ожиданием очереди потока — так, как его видит вызывающий
+        with metrics.timer("tgparse_db_call_seconds"):
+            return await loop.run_in_executor(self._pool, self._call, fn, args)
+
+    async def fetchone(self, sql: str, params=()) -> Optional[dict]:
+        row = await self.run(lambda con: con.execute(sql, params).fetchone())
+        return dict(row) if row else None
+
+    async def fetchall(self, sql: str, params=()) -> list[dict]:
+        rows = await self.run(lambda con: con.execute(sql, params).fetchall())
+        return [dict(r) for r in rows]
+
+    async def execute(self, sql: str, params=()) -> int:
+        def _execute(con):
+            with con:
+                return con.execute(sql, params).rowcount
+        return await self.run(_execute)
+
+    def defer(self, sql: str, params=()):
+        self.defer_many(sql, [params])
+
+    def defer_many(self, sql: str, seq):
+        with self._pending_lock:
+            self._pending.append((sql, list(seq)))
+            full = sum(len(p) for _, p in self._pending) >= DB_BATCH_SIZE
+        if full:
+            self._pool.submit(self._flush_logged)
+
+    def _flush_logged(self):
+        try: self._flush()
+        except Exception as e: log.error(f"DB flush error: {e}")
+
+    def _flush(self):
+        with self._pending_lock:
+            batch, self._pending = self._pending, []
+        if not batch:
+            return
+        with self.con:
+            for sql, seq in batch:
+                self.con.executemany(sql, seq)
+        self.stats["batches"] += 1
+        self.stats["batched"] += sum(len(p) for _, p in batch)
+
+    async def flush(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._pool, self._flush)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(DB_FLUSH_INTERVAL)
+            if self._pending:
+                await asyncio.get_running_loop().run_in_executor(self._pool, self._flush_logged)
+
+    def start(self):
+        self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._flusher:
+            self._flusher.cancel()
+        await self.flush()
+        self._pool.shutdown(wait=True)
+        self.con.close()
+
+db = Database(DB)
+metrics.gauge("tgparse_db_pending_writes", lambda: sum(len(p) for _, p in db._pending))
+metrics.gauge("tgparse_db_batched_writes", lambda: db.stats["batched"])
+
+# ─── Миграции ─────────────────────────────────────────────────────────────────
+# Версия схемы — PRAGMA user_version; миграция N переводит базу из N-1 в N.
+# Новые изменения схемы — только новой функцией в конце MIGRATIONS. executescript
+# сам коммитит, поэтому миграция должна спокойно переживать повторный запуск.
+def migrate_base(con: sqlite3.Connection):
+    # Базы до появления версий: таблицы могли уже быть — всё через IF NOT EXISTS
+    con.executescript("""
         CREATE TABLE IF NOT EXISTS users (
             user_id     INTEGER PRIMARY KEY,
             username    TEXT,
@@ -127,146 +492,1593 @@ def db_init():
             msg_count   INTEGER,
             created_at  TEXT DEFAULT CURRENT_TIMESTAMP
         );
+        CREATE TABLE IF NOT EXISTS jobs (
+            id          INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id     INTEGER,
+            chat_id     INTEGER,
+            priority    INTEGER,
+            params      TEXT,
+            status      TEXT DEFAULT 'queued',
+            created_at  TEXT DEFAULT CURRENT_TIMESTAMP,
+            started_at  TEXT,
+            finished_at TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status);
+        CREATE TABLE IF NOT EXISTS senders (
+            sender_id   INTEGER PRIMARY KEY,
+            is_user     INTEGER,
+            username    TEXT,
+            first_name  TEXT,
+            last_name   TEXT,
+            title       TEXT,
+            updated_at  REAL
+        );
+        CREATE TABLE IF NOT EXISTS store_messages (
+            chat_id     INTEGER,
+            msg_id      INTEGER,
+            ts          INTEGER,
+            uname       TEXT,
+            text        TEXT,
+            PRIMARY KEY (chat_id, msg_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_store_messages_ts ON store_messages(chat_id, ts);
+        CREATE TABLE IF NOT EXISTS store_ranges (
+            chat_id     INTEGER,
+            lo          INTEGER,
+            hi          INTEGER,
+            PRIMARY KEY (chat_id, lo)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS store_chats (
+            chat_id     INTEGER PRIMARY KEY,
+            accessed_at REAL
+        );
+        -- Агрегаты для /admin ведут триггеры: они в той же транзакции, что и сама запись
+        CREATE TABLE IF NOT EXISTS counters (
+            name        TEXT PRIMARY KEY,
+            value       INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            day         TEXT PRIMARY KEY,
+            parses      INTEGER DEFAULT 0,
+            msgs        INTEGER DEFAULT 0,
+            payments    INTEGER DEFAULT 0,
+            revenue     INTEGER DEFAULT 0
+        );
+        CREATE TRIGGER IF NOT EXISTS trg_users_insert AFTER INSERT ON users BEGIN
+            UPDATE counters SET value=value+1 WHERE name='users';
+            UPDATE counters SET value=value+1 WHERE name='paid' AND NEW.plan!='free';
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_users_plan AFTER UPDATE OF plan ON users
+        WHEN (OLD.plan!='free') != (NEW.plan!='free') BEGIN
+            UPDATE counters SET value=value+(CASE WHEN NEW.plan!='free' THEN 1 ELSE -1 END) WHERE name='paid';
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_payments_insert AFTER INSERT ON payments BEGIN
+            UPDATE counters SET value=value+NEW.stars WHERE name='revenue';
+            INSERT INTO daily_stats(day, payments, revenue) VALUES(date(NEW.created_at), 1, NEW.stars)
+                ON CONFLICT(day) DO UPDATE SET payments=payments+1, revenue=revenue+excluded.revenue;
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_parse_log_insert AFTER INSERT ON parse_log BEGIN
+            UPDATE counters SET value=value+1 WHERE name='parses';
+            UPDATE counters SET value=value+NEW.msg_count WHERE name='msgs';
+            INSERT INTO daily_stats(day, parses, msgs) VALUES(date(NEW.created_at), 1, NEW.msg_count)
+                ON CONFLICT(day) DO UPDATE SET parses=parses+1, msgs=msgs+excluded.msgs;
+        END;
     """)
-    con.commit()
-    con.close()
-
-def db_get_user(user_id: int) -> dict:
-    con = sqlite3.connect(DB)
-    con.row_factory = sqlite3.Row
-    row = con.execute("SELECT * FROM users WHERE user_id=?", (user_id,)).fetchone()
-    con.close()
+    if not con.execute("SELECT 1 FROM counters").fetchone():
+        # Один раз досчитываем то, что накопилось до появления агрегатов. Через execute,
+        # а не executescript: досчёт идёт в одной транзакции с user_version, и прерванная
+        # миграция при повторе выполнит его заново целиком
+        con.execute("""
+            INSERT OR IGNORE INTO counters(name, value)
+                SELECT 'users', COUNT(*) FROM users
+                UNION ALL SELECT 'paid', COUNT(*) FROM users WHERE plan!='free'
+                UNION ALL SELECT 'revenue', COALESCE(SUM(stars), 0) FROM payments
+                UNION ALL SELECT 'parses', COUNT(*) FROM parse_log
+                UNION ALL SELECT 'msgs', COALESCE(SUM(msg_count), 0) FROM parse_log""")
+        con.execute("""
+            INSERT INTO daily_stats(day, parses, msgs)
+                SELECT date(created_at), COUNT(*), SUM(msg_count) FROM parse_log GROUP BY 1""")
+        con.execute("""
+            INSERT INTO daily_stats(day, payments, revenue)
+                SELECT date(created_at), COUNT(*), SUM(stars) FROM payments WHERE true GROUP BY 1
+                ON CONFLICT(day) DO UPDATE SET payments=excluded.payments, revenue=excluded.revenue""")
+
+def migrate_next_run(con: sqlite3.Connection):
+    cols = {r["name"] for r in con.execute("PRAGMA table_info(schedules)")}
+    if "next_run" not in cols:
+        con.execute("ALTER TABLE schedules ADD COLUMN next_run TEXT")
+    # Старые расписания: следующий запуск — через interval_h после last_run (или сразу)
+    now = datetime.now(timezone.utc)
+    for r in con.execute("SELECT id, interval_h, last_run FROM schedules WHERE next_run IS NULL").fetchall():
+        nxt = now
+        if r["last_run"]:
+            nxt = datetime.fromisoformat(r["last_run"]).replace(tzinfo=timezone.utc) + timedelta(hours=r["interval_h"])
+        con.execute("UPDATE schedules SET next_run=? WHERE id=?", (iso_utc(nxt), r["id"]))
+
+def migrate_indexes(con: sqlite3.Connection):
+    con.executescript("""
+        CREATE INDEX IF NOT EXISTS idx_schedules_user     ON schedules(user_id, active);
+        CREATE INDEX IF NOT EXISTS idx_schedules_next_run ON schedules(next_run);
+        CREATE INDEX IF NOT EXISTS idx_parse_log_user     ON parse_log(user_id, created_at);
+        CREATE INDEX IF NOT EXISTS idx_payments_user      ON payments(user_id);
+    """)
+
+def migrate_chat_cache(con: sqlite3.Connection):
+    # Результаты поиска чатов: peer_id и название либо ошибка (чат не найден)
+    con.executescript("""
+        CREATE TABLE IF NOT EXISTS chat_cache (
+            key        TEXT PRIMARY KEY,
+            peer_id    INTEGER,
+            title      TEXT,
+            error      TEXT,
+            checked_at INTEGER NOT NULL
+        ) WITHOUT ROWID;
+    """)
+
+def migrate_result_cache(con: sqlite3.Connection):
+    # Готовые выгрузки на диске: parts — [[имя, путь, file_id], ...], counts — строк по каждому чату
+    con.executescript("""
+        CREATE TABLE IF NOT EXISTS result_cache (
+            key        TEXT PRIMARY KEY,
+            parts      TEXT NOT NULL,
+            counts     TEXT NOT NULL,
+            msgs       INTEGER NOT NULL,
+            users      INTEGER NOT NULL,
+            bytes      INTEGER NOT NULL,
+            created_at INTEGER NOT NULL,
+            used_at    INTEGER NOT NULL
+        ) WITHOUT ROWID;
+    """)
+
+MIGRATIONS = [migrate_base, migrate_next_run, migrate_indexes, migrate_chat_cache, migrate_result_cache]
+
+def db_init():
+    db.open()
+    version = db.con.execute("PRAGMA user_version").fetchone()[0]
+    for n, migrate in enumerate(MIGRATIONS[version:], version + 1):
+        with db.con:
+            migrate(db.con)
+            db.con.execute(f"PRAGMA user_version={n}")
+        log.info(f"DB migrated to v{n}: {migrate.__name__}")
+
+async def db_get_user(user_id: int) -> dict:
+    row = await db.fetchone("SELECT * FROM users WHERE user_id=?", (user_id,))
     if not row:
         return {"user_id": user_id, "plan": "free", "msgs_used": 0, "plan_until": None}
-    return dict(row)
+    return row
 
 def db_upsert_user(user_id: int, username: str):
-    con = sqlite3.connect(DB)
-    con.execute("""
+    db.defer("""
         INSERT INTO users(user_id, username) VALUES(?,?)
         ON CONFLICT(user_id) DO UPDATE SET username=excluded.username
     """, (user_id, username or ""))
-    con.commit(); con.close()
 
-def db_set_plan(user_id: int, plan: str, days: int = 30):
+async def db_set_plan(user_id: int, plan: str, days: int = 30):
     until = (datetime.now() + timedelta(days=days)).isoformat()
-    con = sqlite3.connect(DB)
-    con.execute("UPDATE users SET plan=?, plan_until=? WHERE user_id=?", (plan, until, user_id))
-    con.commit(); con.close()
+    await db.execute("UPDATE users SET plan=?, plan_until=? WHERE user_id=?", (plan, until, user_id))
+    plan_cache.invalidate(user_id)
 
-def db_add_payment(user_id: int, plan: str, stars: int):
-    con = sqlite3.connect(DB)
-    con.execute("INSERT INTO payments(user_id,plan,stars) VALUES(?,?,?)", (user_id, plan, stars))
-    con.commit(); con.close()
+async def db_add_payment(user_id: int, plan: str, stars: int):
+    await db.execute("INSERT INTO payments(user_id,plan,stars) VALUES(?,?,?)", (user_id, plan, stars))
 
 def db_log_parse(user_id: int, chat: str, count: int):
-    con = sqlite3.connect(DB)
-    con.execute("INSERT INTO parse_log(user_id,chat,msg_count) VALUES(?,?,?)", (user_id, chat, count))
-    con.execute("UPDATE users SET msgs_used=msgs_used+? WHERE user_id=?", (count, user_id))
-    con.commit(); con.close()
-
-def db_get_schedules(active_only=True) -> list:
-    con = sqlite3.connect(DB)
-    con.row_factory = sqlite3.Row
-    q = "SELECT * FROM schedules" + (" WHERE active=1" if active_only else "")
-    rows = con.execute(q).fetchall()
-    con.close()
-    return [dict(r) for r in rows]
-
-def db_add_schedule(user_id: int, chat: str, interval_h: int):
-    con = sqlite3.connect(DB)
-    con.execute("INSERT INTO schedules(user_id,chat,interval_h) VALUES(?,?,?)", (user_id, chat, interval_h))
-    con.commit(); con.close()
-
-def db_stats() -> dict:
-    con = sqlite3.connect(DB)
-    stats = {
-        "users":    con.execute("SELECT COUNT(*) FROM users").fetchone()[0],
-        "paid":     con.execute("SELECT COUNT(*) FROM users WHERE plan!='free'").fetchone()[0],
-        "revenue":  con.execute("SELECT SUM(stars) FROM payments").fetchone()[0] or 0,
-        "parses":   con.execute("SELECT COUNT(*) FROM parse_log").fetchone()[0],
-        "msgs":     con.execute("SELECT SUM(msg_count) FROM parse_log").fetchone()[0] or 0,
-    }
-    con.close()
-    return stats
+    db.defer("INSERT INTO parse_log(user_id,chat,msg_count) VALUES(?,?,?)", (user_id, chat, count))
+    db.defer("UPDATE users SET msgs_used=msgs_used+? WHERE user_id=?", (count, user_id))
+
+async def db_add_job(user_id: int, chat_id: int, priority: int, params: dict) -> int:
+    def _add(con):
+        with con:
+            return con.execute("INSERT INTO jobs(user_id,chat_id,priority,params) VALUES(?,?,?,?)",
+                               (user_id, chat_id, priority, json.dumps(params, ensure_ascii=False))).lastrowid
+    return await db.run(_add)
+
+async def db_set_job_status(job_id: int, status: str):
+    # queued → running → done | failed | cancelled
+    col = {"running": "started_at", "queued": None}.get(status, "finished_at")
+    stamp = f", {col}=CURRENT_TIMESTAMP" if col else ""
+    await db.execute(f"UPDATE jobs SET status=?{stamp} WHERE id=?", (status, job_id))
+    metrics.inc("tgparse_jobs_total", status=status)
+
+async def db_set_jobs_cancelled(ids: list):
+    def _cancel(con):
+        with con:
+            con.executemany("UPDATE jobs SET status='cancelled', finished_at=CURRENT_TIMESTAMP WHERE id=?",
+                            [(i,) for i in ids])
+    await db.run(_cancel)
+
+async def db_get_pending_jobs() -> list:
+    rows = await db.fetchall("SELECT * FROM jobs WHERE status IN ('queued','running') ORDER BY id")
+    for r in rows:
+        r["params"] = json.loads(r["params"])
+    return rows
+
+async def db_get_user_schedules(user_id: int) -> list:
+    return await db.fetchall("SELECT * FROM schedules WHERE user_id=? AND active=1 ORDER BY id", (user_id,))
+
+async def db_get_user_activity(user_id: int, days: int = 30) -> dict:
+    return await db.fetchone("""
+        SELECT COUNT(*) AS parses, COALESCE(SUM(msg_count), 0) AS msgs FROM parse_log
+        WHERE user_id=? AND created_at >= datetime('now', ?)
+    """, (user_id, f"-{days} days"))
+
+async def db_add_schedule(user_id: int, chat: str, interval_h: int):
+    await db.execute("INSERT INTO schedules(user_id,chat,interval_h,next_run) VALUES(?,?,?,?)",
+                     (user_id, chat, interval_h, iso_utc(datetime.now(timezone.utc))))
+
+async def db_get_due_schedules(now: datetime) -> list:
+    return await db.fetchall(
+        "SELECT * FROM schedules WHERE next_run<=? AND active=1 ORDER BY next_run", (iso_utc(now),))
+
+async def db_next_schedule_run(exclude=()) -> Optional[datetime]:
+    sql = "SELECT MIN(next_run) AS nxt FROM schedules WHERE active=1"
+    if exclude:
+        sql += f" AND id NOT IN ({','.join('?' * len(exclude))})"
+    row = await db.fetchone(sql, tuple(exclude))
+    return datetime.fromisoformat(row["nxt"]) if row and row["nxt"] else None
+
+async def db_update_schedules(ids: list, next_run: datetime, last_run: Optional[datetime] = None):
+    # last_run и next_run меняются одной транзакцией для всей группы
+    if last_run is None:
+        sql, params = "UPDATE schedules SET next_run=? WHERE id=?", [(iso_utc(next_run), i) for i in ids]
+    else:
+        sql = "UPDATE schedules SET last_run=?, next_run=? WHERE id=?"
+        params = [(last_run.isoformat(), iso_utc(next_run), i) for i in ids]
+    def _update(con):
+        with con:
+            con.executemany(sql, params)
+    await db.run(_update)
+
+async def db_stats() -> dict:
+    rows = await db.fetchall("SELECT name, value FROM counters")
+    return {r["name"]: r["value"] for r in rows}
+
+async def db_daily_stats(days: int = 7) -> list:
+    return await db.fetchall("SELECT * FROM daily_stats ORDER BY day DESC LIMIT ?", (days,))
+
+async def db_prune_parse_log() -> int:
+    # Старые строки уже учтены в counters и daily_stats — сырые больше не нужны
+    return await db.execute("DELETE FROM parse_log WHERE created_at < datetime('now', ?)",
+                            (f"-{PARSE_LOG_DAYS} days",))
+
+async def db_prune_chat_cache() -> int:
+    return await db.execute("DELETE FROM chat_cache WHERE checked_at < ?", (int(time.time()) - CHAT_CACHE_TTL,))
+
+async def housekeeping_loop():
+    while True:
+        try:
+            n = await db_prune_parse_log()
+            if n: log.info(f"parse_log: удалено {n} строк старше {PARSE_LOG_DAYS} дн.")
+            await db_prune_chat_cache()
+            await result_cache.evict()
+        except Exception as e:
+            log.error(f"Housekeeping error: {e}")
+        await asyncio.sleep(24 * 3600)
 
 # ─── Проверка плана ───────────────────────────────────────────────────────────
-def get_user_plan(user_id: int) -> dict:
-    u = db_get_user(user_id)
-    plan_key = u.get("plan", "free")
+class PlanCache:
+    """Тариф и срок его действия в памяти процесса.
+
+    plan_until меняется только через db_set_plan, который сбрасывает запись,
+    поэтому истечение тарифа замечаем по часам, без похода в БД.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._entries: "OrderedDict[int, tuple[str, Optional[datetime]]]" = OrderedDict()
+        self.hits = self.misses = 0
+
+    def get(self, user_id: int) -> Optional[dict]:
+        entry = self._entries.get(user_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(user_id)
+        return resolve_plan(*entry)
+
+    def put(self, user_id: int, plan_key: str, until: Optional[datetime]):
+        self._entries[user_id] = (plan_key, until)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        self._entries.pop(user_id, None)
+
+plan_cache = PlanCache(PLAN_CACHE_SIZE)
+metrics.gauge("tgparse_plan_cache_total", lambda: plan_cache.hits, result="hit")
+metrics.gauge("tgparse_plan_cache_total", lambda: plan_cache.misses, result="miss")
+
+def resolve_plan(plan_key: str, until: Optional[datetime]) -> dict:
     # Проверяем не истёк ли план
-    if plan_key != "free" and u.get("plan_until"):
-        if datetime.fromisoformat(u["plan_until"]) < datetime.now():
-            plan_key = "free"
+    if plan_key != "free" and until and until < datetime.now():
+        plan_key = "free"
     return PLANS.get(plan_key, PLANS["free"])
 
-# ─── Парсер ───────────────────────────────────────────────────────────────────
-async def parse_messages(chat, date_from, date_to, limit, keywords=None, progress_cb=None):
-    rows = []
-    async with TelegramClient(SESSION, API_ID, API_HASH) as client:
+async def get_user_plan(user_id: int) -> dict:
+    plan = plan_cache.get(user_id)
+    if plan is not None:
+        return plan
+    u = await db_get_user(user_id)
+    plan_key = u.get("plan") or "free"
+    until = datetime.fromisoformat(u["plan_until"]) if u.get("plan_until") else None
+    plan_cache.put(user_id, plan_key, until)
+    return resolve_plan(plan_key, until)
+
+# ─── Telethon-клиент ─────────────────────────────────────────────────────────
+class TgClientManager:
+    """Один постоянно подключённый клиент на процесс вместо connect на каждый парсинг."""
+
+    def __init__(self, session, api_id, api_hash):
+        self.session, self.api_id, self.api_hash = session, api_id, api_hash
+        self.client: Optional[TelegramClient] = None
+        self._lock = asyncio.Lock()
+
+    async def start(self):
+        async with self._lock:
+            if self.client is None:
+                # FloodWait не глотаем внутри Telethon — им управляет общий FloodLimiter
+                client = TelegramClient(self.session, self.api_id, self.api_hash, flood_sleep_threshold=0)
+                await client.start()
+                self.client = client
+                log.info("Telethon client connected")
+
+    async def get(self) -> TelegramClient:
+        if self.client is None:
+            await self.start()
+        if self.client.is_connected():
+            return self.client
+
+        async with self._lock:
+            delay = 1
+            for attempt in range(1, TG_RECONNECT_TRIES + 1):
+                if self.client.is_connected():
+                    return self.client
+                try:
+                    await self.client.connect()
+                    log.info(f"Telethon reconnected (attempt {attempt})")
+                    return self.client
+                except (OSError, ConnectionError) as e:
+                    log.warning(f"Telethon reconnect failed ({attempt}/{TG_RECONNECT_TRIES}): {e}")
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 60)
+        raise ConnectionError("Нет соединения с Telegram, попробуй позже")
+
+    async def stop(self):
+        async with self._lock:
+            if self.client is not None:
+                await self.client.disconnect()
+                self.client = None
+                log.info("Telethon client disconnected")
+
+class AccountFlooded(Exception):
+    """Аккаунт ушёл в долгий FloodWait, а в пуле есть другие — парсинг переезжает."""
+
+    def __init__(self, seconds: int):
+        super().__init__(f"FloodWait {seconds}s")
+        self.seconds = seconds
+
+class FloodLimiter:
+    """Общий на аккаунт лимит параллельных парсингов; FloodWait ставит на паузу всех."""
+
+    def __init__(self, concurrency: int, name: str = ""):
+        self.concurrency, self.name = concurrency, name
+        self._sem = asyncio.Semaphore(concurrency)
+        self._resume_at = 0.0
+        self.failover = False   # True — в пуле есть куда переехать при долгом FloodWait
+
+    @property
+    def cooldown(self) -> float:
+        return max(0.0, self._resume_at - time.monotonic())
+
+    @property
+    def free(self) -> bool:
+        return not self._sem.locked()
+
+    async def __aenter__(self):
+        await self._sem.acquire()
+        await self.wait()
+        return self
+
+    async def __aexit__(self, *exc):
+        self._sem.release()
+
+    async def borrow(self, n: int) -> int:
+        # Дополнительные слоты для срезов одного чата — только свободные, без ожидания:
+        # парсинг уже держит свой слот, и ожидание чужих могло бы заблокировать всех
+        got = 0
+        while got < n and not self._sem.locked():
+            await self._sem.acquire()
+            got += 1
+        return got
+
+    def give_back(self, n: int):
+        for _ in range(n):
+            self._sem.release()
+
+    def flood(self, seconds: int):
+        self._resume_at = max(self._resume_at, time.monotonic() + seconds)
+        metrics.inc("tgparse_flood_waits_total", account=self.name)
+        metrics.inc("tgparse_flood_wait_seconds_total", seconds, account=self.name)
+        if self.failover and seconds >= FLOOD_FAILOVER_SEC:
+            raise AccountFlooded(seconds)
+        if seconds > FLOOD_MAX_WAIT:
+            raise RuntimeError(f"Telegram ограничил запросы на {seconds} сек, попробуй позже — "
+                               f"уже скачанное сохранено, повтор продолжит с места остановки")
+        log.warning(f"[{self.name}] FloodWait {seconds}s — pausing parses on this account")
+
+    async def wait(self):
+        # Долгая пауза при пуле аккаунтов — не спим, а переезжаем (SessionPool.run).
+        # Так же уходят и соседние парсинги этого аккаунта, а не только поймавший FloodWait
+        if self.failover and self.cooldown >= FLOOD_FAILOVER_SEC:
+            raise AccountFlooded(round(self.cooldown))
+        while (delay := self._resume_at - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+
+    async def call(self, fn, *args, **kwargs):
+        while True:
+            await self.wait()
+            try:
+                return await fn(*args, **kwargs)
+            except FloodWaitError as e:
+                self.flood(e.seconds)
+
+
+class TgAccount:
+    """Аккаунт пула: свой клиент, свой бюджет FloodWait и счётчики нагрузки."""
+
+    def __init__(self, name: str, session: str, api_id: int, api_hash: str):
+        self.name = name
+        self.manager = TgClientManager(session, api_id, api_hash)
+        self.limiter = FloodLimiter(PARSE_CONCURRENCY, name)
+        self.active = self.parses = self.failovers = 0
+
+class KeyedLocks:
+    """asyncio.Lock на ключ; запись удаляется, когда замок никто не держит и не ждёт."""
+
+    def __init__(self):
+        self._entries: dict = {}   # ключ → [замок, сколько держат или ждут]
+
+    @asynccontextmanager
+    async def hold(self, key):
+        entry = self._entries.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
         try:
-            entity = await client.get_entity(chat)
-        except Exception as e:
-            raise ValueError(f"Чат не найден: {e}")
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._entries[key]
+
+    def busy(self) -> set:
+        return set(self._entries)
+
+class SessionPool:
+    """Несколько Telethon-сессий вместо одной (TG_SESSIONS).
+
+    Чат закрепляется за аккаунтом (кэш сущностей Telethon остаётся тёплым), пока
+    тот не на паузе и не занят; иначе берётся самый здоровый: без FloodWait,
+    с наименьшей загрузкой. Долгий FloodWait посреди парсинга бросает
+    AccountFlooded — парсинг перезапускается на другом аккаунте и продолжает с
+    сохранённого в хранилище места.
+    """
+
+    def __init__(self, specs: list[str]):
+        self.accounts = []
+        for spec in specs:
+            # "session" или "session:api_id:api_hash" — если у аккаунта своё приложение
+            session, _, creds = spec.partition(":")
+            api_id, _, api_hash = creds.partition(":")
+            name = os.path.basename(session)
+            self.accounts.append(TgAccount(name, session, int(api_id) if api_id else API_ID, api_hash or API_HASH))
+        for account in self.accounts:
+            account.limiter.failover = len(self.accounts) > 1
+        self._affinity: "OrderedDict[str, TgAccount]" = OrderedDict()
+        self._chats = KeyedLocks()
+
+    def pick(self, chat: str) -> TgAccount:
+        key = chat.strip().lower()
+        ready = [a for a in self.accounts if not a.limiter.cooldown]
+        account = self._affinity.get(key)
+        if account not in ready or not account.limiter.free:
+            account = min(ready or self.accounts,
+                          key=lambda a: (a.limiter.cooldown, a.active / a.limiter.concurrency, a.failovers))
+        self._affinity[key] = account
+        self._affinity.move_to_end(key)
+        while len(self._affinity) > 10000:
+            self._affinity.popitem(last=False)
+        return account
+
+    async def run(self, chat: str, fn):
+        """await fn(client, limiter) на выбранном аккаунте; при AccountFlooded — на следующем."""
+        # Замок чата берётся до слота аккаунта: второй парсинг того же чата ждёт,
+        # не занимая слот, который нужен другим чатам
+        async with self._chats.hold(chat.strip().lower()):
+            return await self._run(chat, fn)
+
+    async def _run(self, chat: str, fn):
+        while True:
+            account = self.pick(chat)
+            if account.limiter.cooldown > FLOOD_MAX_WAIT:
+                raise RuntimeError(f"Все аккаунты на паузе FloodWait ещё {account.limiter.cooldown:.0f} сек, "
+                                   f"попробуй позже — уже скачанное сохранено")
+            if account.limiter.cooldown:
+                # Свободных от FloodWait нет — ждём ближайший, не занимая его слот
+                await asyncio.sleep(account.limiter.cooldown)
+            async with account.limiter:
+                account.active += 1
+                try:
+                    client = await account.manager.get()
+                    result = await fn(client, account.limiter)
+                    account.parses += 1
+                    return result
+                except AccountFlooded as e:
+                    account.failovers += 1
+                    log.warning(f"[{account.name}] FloodWait {e.seconds}s — {chat} переезжает на другой аккаунт")
+                finally:
+                    account.active -= 1
+
+    async def start(self):
+        for account in self.accounts:
+            try:
+                await account.manager.start()
+            except Exception as e:
+                log.error(f"[{account.name}] Telethon start failed: {e}")
+
+    async def stop(self):
+        for account in self.accounts:
+            await account.manager.stop()
+
+    def status(self) -> str:
+        return "\n".join(
+            f"• `{a.name}`: {a.active}/{a.limiter.concurrency} в работе, {a.parses:,} парсингов, "
+            f"{a.failovers:,} переездов" + (f", пауза {a.limiter.cooldown:.0f} с" if a.limiter.cooldown else "")
+            for a in self.accounts
+        )
 
-        chat_title = getattr(entity, "title", chat)
-        iter_kw = dict(entity=entity, limit=limit)
-        if date_to:   iter_kw["offset_date"] = date_to
-        if date_from: iter_kw["reverse"] = True; iter_kw["offset_date"] = date_from
+pool = SessionPool([spec.strip() for spec in TG_SESSIONS.split(",") if spec.strip()])
+for account in pool.accounts:
+    metrics.gauge("tgparse_account_active", lambda a=account: a.active, account=account.name)
+    metrics.gauge("tgparse_account_cooldown_seconds", lambda a=account: a.limiter.cooldown, account=account.name)
+
+# ─── Кэш отправителей ─────────────────────────────────────────────────────────
+class CachedSender(NamedTuple):
+    sender_id:  int
+    is_user:    bool
+    username:   Optional[str]
+    first_name: Optional[str]
+    last_name:  Optional[str]
+    title:      Optional[str]
+
+    @classmethod
+    def from_entity(cls, entity) -> "CachedSender":
+        if isinstance(entity, User):
+            return cls(entity.id, True, entity.username, entity.first_name, entity.last_name, None)
+        return cls(entity.id, False, None, None, None, getattr(entity, "title", None))
+
+def format_sender(sender: Optional[CachedSender]) -> str:
+    if sender is None:
+        return "Unknown"
+    if sender.is_user:
+        return f"@{sender.username}" if sender.username else f"{sender.first_name or ''} {sender.last_name or ''}".strip()
+    return sender.title or "Unknown"
+
+class SenderCache:
+    """LRU+TTL в памяти поверх таблицы senders; в сеть — только для настоящих промахов."""
+
+    def __init__(self, size: int, ttl: int):
+        self.size, self.ttl = size, ttl
+        self._mem: "OrderedDict[int, tuple[CachedSender, float]]" = OrderedDict()
+        self._dirty: dict[int, CachedSender] = {}
+        self.stats = {"hits": 0, "batch": 0, "db": 0, "network": 0}
+
+    def _get_mem(self, sender_id: int) -> Optional[CachedSender]:
+        item = self._mem.get(sender_id)
+        if item is None:
+            return None
+        if time.time() - item[1] > self.ttl:
+            del self._mem[sender_id]
+            return None
+        self._mem.move_to_end(sender_id)
+        return item[0]
+
+    def _put(self, sender: CachedSender, ts: Optional[float] = None, persist=True) -> CachedSender:
+        self._mem[sender.sender_id] = (sender, ts or time.time())
+        self._mem.move_to_end(sender.sender_id)
+        while len(self._mem) > self.size:
+            self._mem.popitem(last=False)
+        if persist:
+            self._dirty[sender.sender_id] = sender
+        return sender
+
+    async def _get_db(self, sender_id: int) -> Optional[CachedSender]:
+        row = await db.fetchone(
+            "SELECT sender_id,is_user,username,first_name,last_name,title,updated_at FROM senders WHERE sender_id=?",
+            (sender_id,))
+        if not row or time.time() - row["updated_at"] > self.ttl:
+            return None
+        return self._put(CachedSender(row["sender_id"], bool(row["is_user"]), row["username"],
+                                      row["first_name"], row["last_name"], row["title"]),
+                         ts=row["updated_at"], persist=False)
+
+    async def resolve(self, msg) -> Optional[CachedSender]:
+        sender_id = msg.sender_id
+        if sender_id is None:
+            return None
+        cached = self._get_mem(sender_id)
+        if cached:
+            self.stats["hits"] += 1
+            return cached
+
+        # Пользователи/чаты, пришедшие вместе с пачкой истории, уже лежат в msg.sender.
+        # min-сущности (без username) годятся только если в кэше нет ничего лучше.
+        batch = msg.sender
+        if batch is not None and not getattr(batch, "min", False):
+            self.stats["batch"] += 1
+            return self._put(CachedSender.from_entity(batch))
+
+        cached = await self._get_db(sender_id)
+        if cached:
+            self.stats["db"] += 1
+            return cached
+
+        self.stats["network"] += 1
+        try:
+            with metrics.timer("tgparse_sender_network_seconds"):
+                entity = await msg.get_sender()
+        except (ValueError, TypeError, BadRequestError):
+            entity = batch   # отправитель недоступен; FloodWaitError уходит в цикл парсинга
+        if entity is None:
+            return None
+        return self._put(CachedSender.from_entity(entity))
+
+    def flush(self):
+        if not self._dirty:
+            return
+        batch, self._dirty = list(self._dirty.values()), {}
+        now = time.time()
+        db.defer_many(
+            "INSERT OR REPLACE INTO senders(sender_id,is_user,username,first_name,last_name,title,updated_at) "
+            "VALUES(?,?,?,?,?,?,?)",
+            [(*s, now) for s in batch])
+
+senders = SenderCache(SENDER_CACHE_SIZE, SENDER_CACHE_TTL)
+for source in ("hits", "batch", "db", "network"):
+    metrics.gauge("tgparse_sender_resolve_total", lambda k=source: senders.stats[k], source=source)
+
+# ─── Поиск чатов ──────────────────────────────────────────────────────────────
+CHAT_LINK_RE = re.compile(r"^(?:https?://)?(?:www\.)?(?:t|telegram)\.(?:me|dog)/([^?#]+)", re.I)
+USERNAME_RE  = re.compile(r"^[a-z][a-z0-9_]{3,31}$")
+
+def canonical_chat(raw: str) -> str:
+    """Ключ чата: username в нижнем регистре, +хэш приглашения или числовой id.
+
+    @Name, name, t.me/name, t.me/s/name и https://t.me/name/123 дают один и тот же ключ.
+    """
+    text = raw.strip()
+    m = CHAT_LINK_RE.match(text)
+    if m:
+        parts = m.group(1).strip("/").split("/")
+        if parts[0] == "joinchat" and len(parts) > 1:
+            return "+" + parts[1]
+        if parts[0] == "s" and len(parts) > 1:
+            parts = parts[1:]
+        if parts[0] == "c" and len(parts) > 1 and parts[1].isdigit():
+            return f"-100{parts[1]}"   # ссылка на сообщение приватного канала
+        text = parts[0]
+    if text.startswith("+") and len(text) > 1:
+        return text                    # приглашение (или телефон контакта) — регистр важен
+    text = text.lstrip("@")
+    if re.fullmatch(r"-?\d+", text):
+        return text
+    if USERNAME_RE.match(text.lower()):
+        return text.lower()
+    raise ValueError(f"«{raw.strip()}» не похоже на @username, ссылку t.me или id чата")
+
+def chat_display(key: str) -> str:
+    """Как чат показывается и хранится в задачах и расписаниях."""
+    if key[0].isalpha():
+        return f"@{key}"
+    if key.startswith("+") and not key[1:].isdigit():
+        return f"t.me/{key}"
+    return key
+
+def chat_account_bound(key: str) -> bool:
+    """Найдётся ли чат, зависит от аккаунта: приглашение, телефон контакта или id."""
+    return not key[0].isalpha()
+
+def chat_target(key: str):
+    """Что передать в get_entity для ключа."""
+    if key.startswith("+") and not key[1:].isdigit():
+        return f"https://t.me/{key}"
+    if key.lstrip("-").isdigit():
+        return int(key)
+    return key
+
+class ChatInfo(NamedTuple):
+    peer_id: Optional[int]
+    title:   Optional[str]
+    error:   Optional[str]   # не None — чат не найден, peer_id пуст
+
+class ChatResolver:
+    """peer_id и название чатов в памяти и в таблице chat_cache; ResolveUsername — только для промахов.
+
+    access_hash у каждого аккаунта пула свой — его Telethon сам хранит в файле
+    сессии, get_input_entity(peer_id) достаёт его без сети. Ненайденные чаты
+    тоже запоминаются (на CHAT_MISS_TTL), чтобы опечатка не стоила запроса.
+    """
+
+    def __init__(self, size: int, ttl: int, miss_ttl: int):
+        self.size, self.ttl, self.miss_ttl = size, ttl, miss_ttl
+        self._mem: "OrderedDict[str, tuple[ChatInfo, float]]" = OrderedDict()
+        self._checks = asyncio.Semaphore(CHAT_CHECK_CONCURRENCY)
+        self.stats = {"hits": 0, "db": 0, "network": 0, "session": 0}
+
+    def _fresh(self, info: ChatInfo, ts: float) -> bool:
+        return time.time() - ts <= (self.miss_ttl if info.error else self.ttl)
+
+    def _put(self, key: str, info: ChatInfo, ts: Optional[float] = None, persist=True) -> ChatInfo:
+        ts = ts or time.time()
+        self._mem[key] = (info, ts)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.size:
+            self._mem.popitem(last=False)
+        if persist:
+            db.defer("INSERT OR REPLACE INTO chat_cache(key,peer_id,title,error,checked_at) VALUES(?,?,?,?,?)",
+                     (key, *info, int(ts)))
+        return info
+
+    async def cached(self, key: str) -> Optional[ChatInfo]:
+        item = self._mem.get(key)
+        if item and self._fresh(*item):
+            self._mem.move_to_end(key)
+            self.stats["hits"] += 1
+            return item[0]
+        row = await db.fetchone("SELECT peer_id,title,error,checked_at FROM chat_cache WHERE key=?", (key,))
+        if row:
+            info = ChatInfo(row["peer_id"], row["title"], row["error"])
+            if self._fresh(info, row["checked_at"]):
+                self.stats["db"] += 1
+                return self._put(key, info, ts=row["checked_at"], persist=False)
+        return None
+
+    async def resolve(self, client, limiter: "FloodLimiter", chat: str):
+        """(сущность для запросов, ChatInfo). ValueError — чата нет или ссылка кривая."""
+        key = canonical_chat(chat)
+        info = await self.cached(key)
+        if info and info.error:
+            raise ValueError(info.error)
+        if info:
+            try:
+                peer = await client.get_input_entity(info.peer_id)
+                self.stats["session"] += 1
+                return peer, info
+            except (ValueError, TypeError, BadRequestError):
+                pass   # этот аккаунт чат ещё не видел — нужен его собственный access_hash
+        self.stats["network"] += 1
+        try:
+            entity = await limiter.call(client.get_entity, chat_target(key))
+        except (ValueError, BadRequestError) as e:
+            # Запоминаем только «такого username нет». Приглашение и id зависят от
+            # аккаунта (не состоит в группе, не видел канал) — другой аккаунт пула их
+            # откроет; а ошибка поверх уже найденного чата — тем более дело аккаунта
+            if info is None and not chat_account_bound(key):
+                self._put(key, ChatInfo(None, None, str(e)))
+            raise ValueError(str(e))
+        title = getattr(entity, "title", None) or getattr(entity, "username", None) or chat_display(key)
+        return entity, self._put(key, ChatInfo(tl_utils.get_peer_id(entity), title, None))
+
+    async def _check_network(self, key: str) -> ChatInfo:
+        async with self._checks:
+            account = pool.pick(chat_display(key))
+            if account.limiter.cooldown:
+                raise RuntimeError(f"{account.name} на паузе FloodWait")
+            client = await account.manager.get()
+            _, info = await self.resolve(client, account.limiter, key)
+            return info
+
+    async def check(self, chat: str, network: bool = True) -> tuple[str, Optional[str]]:
+        """Проверка в диалоге: (как показывать чат, ошибка или None).
+
+        Сначала кэш; на промахе — тот же запрос, что сделал бы парсинг (его результат
+        парсинг и возьмёт). Сетевых проверок на весь бот не больше CHAT_CHECK_CONCURRENCY,
+        чтобы вставленный список чатов не выжег FloodWait аккаунта; network=False, очередь
+        не успела за CHAT_CHECK_TIMEOUT или аккаунт на паузе — чат проверит сам парсинг.
+        """
+        try:
+            key = canonical_chat(chat)
+        except ValueError as e:
+            return chat.strip(), str(e)
+        info = await self.cached(key)
+        if info is None:
+            if not network:
+                return chat_display(key), None
+            try:
+                info = await asyncio.wait_for(self._check_network(key), CHAT_CHECK_TIMEOUT)
+            except ValueError as e:
+                return chat_display(key), f"{chat_display(key)}: {e}"
+            except Exception as e:
+                log.info(f"Chat check skipped for {key}: {e!r}")
+                return chat_display(key), None
+        return chat_display(key), (f"{chat_display(key)}: {info.error}" if info.error else None)
+
+chat_resolver = ChatResolver(CHAT_CACHE_SIZE, CHAT_CACHE_TTL, CHAT_MISS_TTL)
+for source in ("hits", "db", "session", "network"):
+    metrics.gauge("tgparse_chat_resolve_total", lambda k=source: chat_resolver.stats[k], source=source)
+
+# ─── Хранилище сообщений ─────────────────────────────────────────────────────
+def split_window(ranges, lo: int, hi: Optional[int]) -> list:
+    """Режет окно [lo, hi] по покрытым диапазонам: [(lo, hi, covered), ...] по возрастанию id."""
+    out, cur = [], lo
+    for r_lo, r_hi in ranges:
+        if r_hi < cur: continue
+        if hi is not None and r_lo > hi: break
+        if r_lo > cur:
+            out.append((cur, r_lo - 1, False))
+        out.append((max(cur, r_lo), r_hi if hi is None else min(r_hi, hi), True))
+        cur = r_hi + 1
+    if hi is None or cur <= hi:
+        out.append((cur, hi, False))
+    return out
+
+def merge_ranges(ranges, lo: int, hi: int) -> list:
+    out = []
+    for r_lo, r_hi in sorted([*ranges, (lo, hi)]):
+        if out and r_lo <= out[-1][1] + 1:
+            out[-1] = (out[-1][0], max(out[-1][1], r_hi))
+        else:
+            out.append((r_lo, r_hi))
+    return out
+
+class MessageStore:
+    """Локальная копия истории чатов: store_messages + покрытые диапазоны id в store_ranges.
+
+    Диапазон [lo, hi] значит «все текстовые сообщения с такими id уже лежат в
+    store_messages», поэтому повторный парсинг качает из Telegram только дыры
+    между диапазонами и хвост новее верхней отметки (min_id).
+    """
+
+    def __init__(self, max_rows: int, max_chats: int, ttl_days: int):
+        self.max_rows, self.max_chats, self.ttl = max_rows, max_chats, ttl_days * 86400
+        self._locks = KeyedLocks()
+        self._ranges: dict[int, list] = {}
+        self._swept_at = 0.0
+
+    def lock(self, chat_id: int) -> AbstractAsyncContextManager:
+        # Один парсинг чата за раз: второй дождётся и возьмёт всё из хранилища
+        return self._locks.hold(chat_id)
+
+    async def ranges(self, chat_id: int) -> list:
+        rows = await db.fetchall("SELECT lo, hi FROM store_ranges WHERE chat_id=? ORDER BY lo", (chat_id,))
+        self._ranges[chat_id] = [(r["lo"], r["hi"]) for r in rows]
+        return self._ranges[chat_id]
+
+    def cover(self, chat_id: int, lo: int, hi: int):
+        merged = merge_ranges(self._ranges.get(chat_id, []), lo, hi)
+        self._ranges[chat_id] = merged
+        db.defer("DELETE FROM store_ranges WHERE chat_id=?", (chat_id,))
+        db.defer_many("INSERT INTO store_ranges(chat_id,lo,hi) VALUES(?,?,?)",
+                      [(chat_id, r_lo, r_hi) for r_lo, r_hi in merged])
+
+    def add(self, rows: list):
+        if rows:
+            db.defer_many("INSERT OR REPLACE INTO store_messages(chat_id,msg_id,ts,uname,text) VALUES(?,?,?,?,?)", rows)
+
+    async def edge(self, chat_id: int, date: datetime) -> Optional[int]:
+        """Граница окна по дате без запроса в Telegram — если она внутри покрытого диапазона."""
+        ts = math.ceil(date.timestamp())   # даты в Telegram целые секунды
+        row = await db.fetchone(
+            "SELECT (SELECT MAX(msg_id) FROM store_messages WHERE chat_id=? AND ts<?) AS before, "
+            "       (SELECT MIN(msg_id) FROM store_messages WHERE chat_id=? AND ts>=?) AS after",
+            (chat_id, ts, chat_id, ts))
+        before, after = row["before"], row["after"]
+        if after is None or (before is not None and before > after):
+            return None
+        for r_lo, r_hi in self._ranges.get(chat_id, []):
+            if r_lo <= (before if before is not None else 1) and after <= r_hi:
+                return before or 0
+        return None
+
+    def touch(self, chat_id: int):
+        db.defer("INSERT OR REPLACE INTO store_chats(chat_id,accessed_at) VALUES(?,?)", (chat_id, time.time()))
+
+    async def read(self, chat_id: int, lo: int, hi: int, asc: bool, chunk: int = 2000):
+        order = "ASC" if asc else "DESC"
+        while lo <= hi:
+            rows = await db.fetchall(
+                f"SELECT msg_id, ts, uname, text FROM store_messages "
+                f"WHERE chat_id=? AND msg_id BETWEEN ? AND ? ORDER BY msg_id {order} LIMIT ?",
+                (chat_id, lo, hi, chunk))
+            for row in rows:
+                yield row
+            if len(rows) < chunk:
+                return
+            if asc: lo = rows[-1]["msg_id"] + 1
+            else:   hi = rows[-1]["msg_id"] - 1
+
+    async def evict(self, chat_id: int):
+        busy = self._locks.busy() - {chat_id}
+        sweep = time.time() - self._swept_at > 3600
+        if sweep:
+            self._swept_at = time.time()
+
+        def _evict(con):
+            with con:
+                # Не больше max_rows на чат: старые сообщения и покрытие под ними обрезаем
+                cut = con.execute(
+                    "SELECT msg_id FROM store_messages WHERE chat_id=? ORDER BY msg_id DESC LIMIT 1 OFFSET ?",
+                    (chat_id, self.max_rows)).fetchone()
+                if cut:
+                    con.execute("DELETE FROM store_messages WHERE chat_id=? AND msg_id<=?", (chat_id, cut[0]))
+                    con.execute("DELETE FROM store_ranges WHERE chat_id=? AND hi<=?", (chat_id, cut[0]))
+                    con.execute("UPDATE store_ranges SET lo=? WHERE chat_id=? AND lo<=?", (cut[0] + 1, chat_id, cut[0]))
+                if not sweep:
+                    return []
+                stale = {r[0] for r in con.execute(
+                    "SELECT chat_id FROM store_chats WHERE accessed_at<?", (time.time() - self.ttl,))}
+                stale |= {r[0] for r in con.execute(
+                    "SELECT chat_id FROM store_chats ORDER BY accessed_at DESC LIMIT -1 OFFSET ?", (self.max_chats,))}
+                stale = [cid for cid in stale if cid not in busy and cid != chat_id]
+                for table in ("store_messages", "store_ranges", "store_chats"):
+                    con.executemany(f"DELETE FROM {table} WHERE chat_id=?", [(cid,) for cid in stale])
+                return stale
+
+        for cid in await db.run(_evict):
+            self._ranges.pop(cid, None)
+        self._ranges.pop(chat_id, None)
+
+store = MessageStore(STORE_MAX_ROWS, STORE_MAX_CHATS, STORE_TTL_DAYS)
+
+# ─── Ключевые слова ──────────────────────────────────────────────────────────
+def _trie_regex(words: list) -> str:
+    # Префиксное дерево → одна регулярка без перебора альтернатив: (?:при(?:вет|каз)|пока)
+    trie: dict = {}
+    for w in words:
+        node = trie
+        for ch in w:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    def build(node) -> str:
+        end = "" in node
+        alts = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not alts:
+            return ""
+        body = alts[0] if len(alts) == 1 else "(?:" + "|".join(alts) + ")"
+        if end:
+            body = "(?:" + body + ")?"
+        return body
+
+    return build(trie)
+
+class KeywordMatcher:
+    """Фильтр по ключевым словам, компилируется один раз на запрос.
+
+    Термы через запятую: `цена` — подстрока, `"цена"` — целое слово,
+    `-спам` — исключить сообщение. Регистр не важен (casefold).
+    """
+
+    def __init__(self, terms):
+        self.terms = [t.strip() for t in terms if t.strip()]
+        include, include_words, exclude, exclude_words = [], [], [], []
+        for term in self.terms:
+            negative = term.startswith("-")
+            term = term.lstrip("-").strip()
+            whole = len(term) > 1 and term[0] == term[-1] == '"'
+            term = term.strip('"').strip().casefold()
+            if not term:
+                continue
+            if negative: (exclude_words if whole else exclude).append(term)
+            else:        (include_words if whole else include).append(term)
+
+        self._include = self._compile(include, include_words)
+        self._exclude = self._compile(exclude, exclude_words)
+        self._exclude_only = not (include or include_words)
+        # Один положительный терм без исключений можно отдать в search= Telegram
+        positives = include + include_words
+        self.server_query = positives[0] if len(positives) == 1 and not (exclude or exclude_words) else None
+
+    @classmethod
+    def parse(cls, text: str) -> Optional["KeywordMatcher"]:
+        matcher = cls(text.split(","))
+        return matcher if matcher else None
+
+    @staticmethod
+    def _compile(subs: list, words: list):
+        parts = []
+        if subs:  parts.append(_trie_regex(subs))
+        if words: parts.append(r"(?<!\w)" + _trie_regex(words) + r"(?!\w)")
+        return re.compile("|".join(parts)) if parts else None
+
+    def __bool__(self):
+        return self._include is not None or self._exclude is not None
+
+    def match(self, text: str) -> bool:
+        folded = text.casefold()
+        if self._exclude is not None and self._exclude.search(folded):
+            return False
+        return self._exclude_only or self._include.search(folded) is not None
 
-        count = 0
-        async for msg in client.iter_messages(**iter_kw):
-            msg_date = msg.date.replace(tzinfo=timezone.utc)
-            if date_from and msg_date < date_from: continue
-            if date_to   and msg_date > date_to:   continue
-            if not msg.text: continue
-            if keywords and not any(k.lower() in msg.text.lower() for k in keywords): continue
+# ─── Парсер ───────────────────────────────────────────────────────────────────
+class RowSpool:
+    """Строки одного чата по мере парсинга — по колонкам, без объекта на строку.
+
+    Отправитель хранится индексом в списке уникальных имён, время и длина
+    текста — в типизированных массивах. Сами тексты пишутся подряд в utf-8 в
+    SpooledTemporaryFile: в памяти до SPOOL_MEM_BYTES, дальше на диске.
+    """
+
+    def __init__(self, chat_title: str):
+        self.chat_title = chat_title
+        self.file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEM_BYTES)
+        self.names: list[str] = []
+        self.users: dict[str, int] = {}     # имя → индекс в names
+        self._user = array("I")
+        self._ts   = array("q")
+        self._len  = array("I")             # длина текста в байтах
+        self.text_bytes = 0
+        self.user_width = self.text_width = 0   # ширины колонок считаются по ходу записи
+
+    def __len__(self):
+        return len(self._ts)
+
+    def add(self, uname: str, text: str, date: datetime):
+        idx = self.users.get(uname)
+        if idx is None:
+            idx = self.users[uname] = len(self.names)
+            self.names.append(uname)
+            if len(uname) > self.user_width: self.user_width = len(uname)
+        data = text.encode()
+        self.file.write(data)
+        self._user.append(idx)
+        self._ts.append(int(date.timestamp()))
+        self._len.append(len(data))
+        self.text_bytes += len(data)
+        if len(text) > self.text_width: self.text_width = len(text)
+
+    def rows(self):
+        # (отправитель, текст, unix-время) в порядке добавления
+        self.file.seek(0)
+        names, read = self.names, self.file.read
+        for idx, ts, size in zip(self._user, self._ts, self._len):
+            yield names[idx], read(size).decode(), ts
+
+    def close(self):
+        self.file.close()
+
+async def message_edge(client, entity, date: datetime, limiter: Optional[FloodLimiter] = None) -> int:
+    """id последнего сообщения строго раньше date (0 — таких нет)."""
+    msgs = await (limiter or pool.accounts[0].limiter).call(client.get_messages, entity, limit=1, offset_date=date)
+    return msgs[0].id if msgs else 0
+
+async def parse_messages(client, chat, date_from, date_to, limit,
+                         keywords: Optional[KeywordMatcher] = None, progress_cb=None,
+                         limiter: Optional[FloodLimiter] = None) -> RowSpool:
+    # limiter — бюджет FloodWait того аккаунта пула, чей client передан
+    started = time.perf_counter()
+    limiter = limiter or pool.accounts[0].limiter
+    try:
+        entity, info = await chat_resolver.resolve(client, limiter, chat)
+    except (RuntimeError, AccountFlooded):
+        raise
+    except Exception as e:
+        raise ValueError(f"Чат не найден: {e}")
+
+    spool = RowSpool(info.title or chat)
+    chat_id = info.peer_id
+    asc = date_from is not None   # с датой начала — от старых к новым, как раньше с reverse=True
+
+    def accept(text, date) -> bool:
+        if date_from and date < date_from: return False
+        if date_to   and date > date_to:   return False
+        if not text: return False
+        if keywords and not keywords.match(text): return False
+        return True
+
+    async def emit(uname, text, date) -> bool:
+        spool.add(uname, text[:500], date)
+        if progress_cb:
+            progress_cb(len(spool))
+        return len(spool) >= limit
+
+    def past_window(date) -> bool:
+        # Дальше по ходу обхода сообщений из окна уже не будет
+        return bool(date_to and date > date_to) if asc else bool(date_from and date < date_from)
+
+    async def fetch_gap(g_lo, g_hi, collect=True) -> bool:
+        # Качаем из Telegram только непокрытый кусок [g_lo, g_hi] (g_hi=None — до самого нового).
+        # True — обход окончен: набран лимит или вышли за окно по дате.
+        # collect=False — только сохранить в хранилище (срез параллельного обхода)
+        min_id, max_id = g_lo - 1, (g_hi + 1 if g_hi is not None else 0)
+        first = last = None
+        reached = completed = False
+        batch = []
+
+        def checkpoint():
+            # Покрытие — всё, что прошли подряд. Сохраняется каждые PARSE_CHECKPOINT
+            # сообщений и при обрыве, так что повтор (или рестарт задачи) прочитает
+            # пройденное из хранилища и докачает только остаток через min_id/max_id
+            nonlocal batch
+            store.add(batch); batch = []
+            if asc:
+                bottom, top = g_lo, (g_hi if completed and g_hi is not None else last)
+            else:
+                bottom, top = (g_lo if completed else last), (g_hi if g_hi is not None else first)
+            if bottom is not None and top is not None and bottom <= top:
+                store.cover(chat_id, bottom, top)
 
+        try:
+            while True:
+                await limiter.wait()
+                try:
+                    paused = False
+                    history = client.iter_messages(entity, min_id=min_id, max_id=max_id, reverse=asc)
+                    async for msg in metrics.timed_iter(history, "tgparse_telegram_wait_seconds"):
+                        if limiter.cooldown:
+                            # FloodWait поймал другой парсинг этого аккаунта — останавливаемся
+                            # и мы, не тратя запросы на следующую страницу; limiter.wait()
+                            # в начале круга подождёт короткую паузу или отправит на другой аккаунт
+                            paused = True
+                            break
+                        date = msg.date.replace(tzinfo=timezone.utc)
+                        # FloodWait на поиске отправителя — до сдвига min_id/max_id,
+                        # чтобы следующий круг начал с этого же сообщения
+                        uname = format_sender(await senders.resolve(msg)) if msg.text else None
+                        # После FloodWait продолжаем с последнего полученного id, а не с начала
+                        if asc: min_id = msg.id
+                        else:   max_id = msg.id
+                        first = first or msg.id
+                        last = msg.id
+                        if uname is not None:
+                            # В хранилище — до проверки окна: id этого сообщения тоже попадёт в покрытие
+                            batch.append((chat_id, msg.id, int(date.timestamp()), uname, msg.text))
+                            if len(batch) >= PARSE_CHECKPOINT:
+                                checkpoint()
+                        if not collect:
+                            continue
+                        if past_window(date):
+                            reached = True
+                            break
+                        if uname is not None and accept(msg.text, date) and await emit(uname, msg.text, date):
+                            reached = True
+                            break
+                    else:
+                        completed = True
+                    if paused:
+                        continue
+                    break
+                except FloodWaitError as e:
+                    limiter.flood(e.seconds)   # ждём в начале следующего круга
+        finally:
+            checkpoint()
+        return reached
+
+    async def read_store(seg_lo, seg_hi) -> bool:
+        async for row in store.read(chat_id, seg_lo, seg_hi, asc):
+            date = datetime.fromtimestamp(row["ts"], timezone.utc)
+            if past_window(date):
+                return True
+            if accept(row["text"], date) and await emit(row["uname"], row["text"], date):
+                return True
+        return False
+
+    async def fetch_sliced(g_lo, g_hi) -> bool:
+        # Большой непокрытый кусок качаем волнами: волна — несколько срезов id, которые
+        # грузятся параллельно, затем читается из хранилища по порядку (оно и склеивает
+        # срезы). Лимит проверяется после каждой волны, так что лишнего — не больше волны
+        if g_hi is None:
+            newest = await limiter.call(client.get_messages, entity, limit=1)
+            if not newest or newest[0].id < g_lo:
+                return False
+            g_hi = newest[0].id
+        extra = await limiter.borrow(PARSE_SLICES - 1)
+        try:
+            width = (extra + 1) * PARSE_SLICE_IDS
+            pos = g_lo if asc else g_hi
+            while g_lo <= pos <= g_hi:
+                w_lo, w_hi = (pos, min(pos + width - 1, g_hi)) if asc else (max(pos - width + 1, g_lo), pos)
+                slices = [asyncio.ensure_future(fetch_gap(a, min(a + PARSE_SLICE_IDS - 1, w_hi), collect=False))
+                          for a in range(w_lo, w_hi + 1, PARSE_SLICE_IDS)]
+                try:
+                    await asyncio.gather(*slices)
+                except BaseException:
+                    # Один срез упал (переезд на другой аккаунт, отмена) — остальные
+                    # останавливаем и дожидаемся, чтобы они сохранили свои чекпоинты
+                    for task in slices:
+                        task.cancel()
+                    await asyncio.gather(*slices, return_exceptions=True)
+                    raise
+                if await read_store(w_lo, w_hi):
+                    return True
+                pos = w_hi + 1 if asc else w_lo - 1
+        finally:
+            limiter.give_back(extra)
+        return False
+
+    async def edge(date) -> int:
+        local = await store.edge(chat_id, date)
+        return local if local is not None else await message_edge(client, entity, date, limiter)
+
+    async def fetch_search(query) -> None:
+        # Поиск на стороне Telegram: несовпадающая история вообще не скачивается
+        min_id, max_id = lo - 1, (hi + 1 if hi is not None else 0)
+        while True:
+            await limiter.wait()
             try:
-                sender = await msg.get_sender()
-                if isinstance(sender, User):
-                    uname = f"@{sender.username}" if sender.username else f"{sender.first_name or ''} {sender.last_name or ''}".strip()
-                else:
-                    uname = getattr(sender, "title", "Unknown")
-            except Exception:
-                uname = "Unknown"
-
-            rows.append({
-                "№": len(rows)+1,
-                "Пользователь": uname,
-                "Запрос": msg.text[:500],
-                "Чат": chat_title,
-                "Дата": msg_date.strftime("%d.%m.%Y %H:%M"),
-            })
-            count += 1
-            if progress_cb and count % 100 == 0:
-                await progress_cb(count)
-
-    return pd.DataFrame(rows)
-
-def df_to_excel(df):
-    buf = io.BytesIO()
-    with pd.ExcelWriter(buf, engine="openpyxl") as w:
-        df.to_excel(w, index=False, sheet_name="Парсинг")
-        ws = w.sheets["Парсинг"]
-        from openpyxl.styles import PatternFill, Font, Alignment
-        for cell in ws[1]:
-            cell.fill = PatternFill("solid", fgColor="1E3A5F")
-            cell.font = Font(bold=True, color="FFFFFF")
-            cell.alignment = Alignment(horizontal="center")
-        for col in ws.columns:
-            ws.column_dimensions[col[0].column_letter].width = min(
-                max(len(str(c.value or "")) for c in col)+4, 60)
-    buf.seek(0); return buf.read()
-
-def df_to_csv(df):
-    return df.to_csv(index=False).encode("utf-8-sig")
+                paused = False
+                found = client.iter_messages(entity, search=query, min_id=min_id, max_id=max_id, reverse=asc)
+                async for msg in metrics.timed_iter(found, "tgparse_telegram_wait_seconds", kind="search"):
+                    if limiter.cooldown:
+                        paused = True   # общий FloodWait аккаунта — ждём вместе со всеми
+                        break
+                    date = msg.date.replace(tzinfo=timezone.utc)
+                    if past_window(date): return
+                    uname = format_sender(await senders.resolve(msg)) if accept(msg.text, date) else None
+                    if asc: min_id = msg.id
+                    else:   max_id = msg.id
+                    if uname is not None and await emit(uname, msg.text, date):
+                        return
+                if not paused:
+                    return
+            except FloodWaitError as e:
+                limiter.flood(e.seconds)   # ждём в начале следующего круга
+
+    try:
+        async with store.lock(chat_id):
+            store.touch(chat_id)
+            ranges = await store.ranges(chat_id)
+            lo = await edge(date_from) + 1 if date_from else 1
+            # Окно «до текущего момента» верхняя граница не нужна — обход остановится по дате
+            hi = await edge(date_to) if date_to and date_to < datetime.now(timezone.utc) - timedelta(minutes=1) else None
+            if hi is None or hi >= lo:
+                segments = split_window(ranges, lo, hi)
+                # Окно не покрыто хранилищем (кроме свежего хвоста) и терм один — ищем на сервере
+                if keywords and keywords.server_query and (
+                        any(not c for _, _, c in segments[:-1]) or not any(c for _, _, c in segments)):
+                    await fetch_search(keywords.server_query)
+                    segments = []
+                sliced = limit >= PARSE_SLICE_MIN and PARSE_SLICES > 1
+                for seg_lo, seg_hi, covered in (segments if asc else reversed(segments)):
+                    if covered:
+                        if await read_store(seg_lo, seg_hi): break
+                    elif sliced and (seg_hi is None or seg_hi - seg_lo >= 2 * PARSE_SLICE_IDS):
+                        if await fetch_sliced(seg_lo, seg_hi): break
+                    elif await fetch_gap(seg_lo, seg_hi):
+                        break
+            await store.evict(chat_id)
+    except BaseException:
+        spool.close()
+        raise
+    finally:
+        senders.flush()
+
+    elapsed = time.perf_counter() - started
+    metrics.observe("tgparse_parse_seconds", elapsed)
+    metrics.observe("tgparse_parse_msgs_per_second", len(spool) / max(elapsed, 1e-6), buckets=RATE_BUCKETS)
+    metrics.inc("tgparse_parsed_messages_total", len(spool))
+    return spool
+
+# ─── Прогресс ────────────────────────────────────────────────────────────────
+class ProgressReporter:
+    """Прогресс парсинга в сообщении бота.
+
+    update() синхронный и ничего не ждёт — парсер зовёт его на каждой строке.
+    Отдельная задача правит сообщение не чаще раза в PROGRESS_INTERVAL и
+    показывает только последнее значение, скорость и ETA до лимита.
+    """
+
+    def __init__(self, message, label: str, total: Optional[int] = None, interval: float = PROGRESS_INTERVAL):
+        self.message, self.label, self.total, self.interval = message, label, total, interval
+        self.count = 0
+        self._started = time.monotonic()
+        self._changed = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task:   # повтор на другом аккаунте пула — отчёт уже идёт
+            return
+        self._started = time.monotonic()
+        self._changed.set()
+        self._task = asyncio.create_task(self._run())
+
+    def update(self, count: int):
+        self.count = count
+        self._changed.set()
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def text(self) -> str:
+        if not self.count:
+            return f"📡 Парсю `{self.label}`..."
+        elapsed = max(time.monotonic() - self._started, 1e-6)
+        rate = self.count / elapsed
+        text = f"📡 `{self.label}`: собрано {self.count:,} · {rate:,.0f} сообщ/с"
+        if self.total and self.total > self.count:
+            text += f" · до лимита ~{(self.total - self.count) / rate:,.0f} с"
+        return text
+
+    async def _run(self):
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            try:
+                await self.message.edit_text(self.text(), parse_mode="Markdown")
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except BadRequest:
+                pass   # «message is not modified» и т.п.
+            except TelegramError as e:
+                log.warning(f"Progress update failed: {e}")
+            await asyncio.sleep(self.interval)
+
+# ─── Экспорт ──────────────────────────────────────────────────────────────────
+EXPORT_COLUMNS = ["№", "Пользователь", "Запрос", "Чат", "Дата"]
+JSONL_KEYS     = ["n", "user", "text", "chat", "date"]
+EXPORT_MEM_BYTES = 8 * 1024 * 1024
+EXPORT_ROW_BYTES = 160   # средняя строка CSV — для оценки размера до парсинга
+EXPORT_FORMATS = {
+    # формат: (расширение, кнопка, размер относительно обычного CSV)
+    "excel": ("xlsx",   "📊 Excel",       0.45),
+    "csv":   ("csv",    "📄 CSV",         1.0),
+    "csvgz": ("csv.gz", "🗜 CSV.gz",      0.25),
+    "zip":   ("zip",    "🗜 ZIP (CSV)",   0.25),
+    "jsonl": ("jsonl",  "🧾 JSON Lines",  1.4),
+}
+export_pool = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix="export")
+
+def export_rows(spools, limit: Optional[int] = None, date_fmt: str = "%d.%m.%Y %H:%M"):
+    # Нумерация и форматирование даты — только в момент записи файла
+    n = 0
+    minute, stamp = None, ""
+    for spool in spools:
+        for uname, text, ts in spool.rows():
+            if limit is not None and n >= limit:
+                return
+            n += 1
+            # Подряд идущие сообщения обычно в одной минуте — строка даты переиспользуется
+            if ts // 60 != minute:
+                minute, stamp = ts // 60, datetime.fromtimestamp(ts, timezone.utc).strftime(date_fmt)
+            yield n, uname, text, spool.chat_title, stamp
+
+def estimate_export_bytes(rows: int, fmt: str, row_bytes: float = EXPORT_ROW_BYTES) -> int:
+    return int(rows * row_bytes * EXPORT_FORMATS[fmt][2])
+
+def spool_row_bytes(spools) -> float:
+    # Средняя строка CSV по уже собранным данным: текст + отправитель, чат, номер и дата
+    n = sum(len(s) for s in spools)
+    if not n:
+        return EXPORT_ROW_BYTES
+    return (sum(s.text_bytes for s in spools) + sum(len(s) * len(s.chat_title.encode()) for s in spools)) / n + 40
+
+def write_csv(rows, out):
+    text = io.TextIOWrapper(out, encoding="utf-8-sig", newline="", write_through=True)
+    w = csv.writer(text, lineterminator="\n")
+    w.writerow(EXPORT_COLUMNS)
+    w.writerows(rows)
+    text.flush(); text.detach()
+
+def write_csv_gz(rows, out):
+    with gzip.GzipFile(fileobj=out, mode="wb", compresslevel=6, mtime=0) as gz:
+        write_csv(rows, gz)
+
+def write_zip(rows, out):
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED, compresslevel=6) as zf:
+        with zf.open("tgparse.csv", "w") as f:
+            write_csv(rows, f)
+
+def write_jsonl(rows, out):
+    for row in rows:
+        out.write(json.dumps(dict(zip(JSONL_KEYS, row)), ensure_ascii=False).encode())
+        out.write(b"\n")
+
+def column_widths(spools) -> list[int]:
+    # Всё уже посчитано в RowSpool.add — второй проход по листу не нужен
+    widths = [
+        len(str(sum(len(s) for s in spools))),
+        max((s.user_width for s in spools), default=0),
+        max((s.text_width for s in spools), default=0),
+        max((len(s.chat_title) for s in spools), default=0),
+        len("01.01.2000 00:00"),
+    ]
+    return [max(w, len(c)) for w, c in zip(widths, EXPORT_COLUMNS)]
+
+def write_xlsx(rows, out, widths: list[int]):
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Парсинг")
+    for i, w in enumerate(widths, 1):
+        ws.column_dimensions[get_column_letter(i)].width = min(w + 4, 60)
+
+    header = []
+    for name in EXPORT_COLUMNS:
+        cell = WriteOnlyCell(ws, value=name)
+        cell.fill = PatternFill("solid", fgColor="1E3A5F")
+        cell.font = Font(bold=True, color="FFFFFF")
+        cell.alignment = Alignment(horizontal="center")
+        header.append(cell)
+    ws.append(header)
+    for row in rows:
+        ws.append(row)
+    wb.save(out)
+
+def until_size(rows, out, max_bytes: int):
+    # Строки части, пока файл не дорастёт до max_bytes; размер проверяется раз в 256 строк
+    for i, row in enumerate(rows, 1):
+        yield row
+        if i % 256 == 0 and out.tell() >= max_bytes:
+            return
+
+def write_export(spools, fmt: str, limit: Optional[int] = None) -> list:
+    """Потоково пишет строки всех чатов в SpooledTemporaryFile.
+
+    Больше EXPORT_PART_BYTES — режет на части с общей нумерацией строк и
+    заголовком в каждой. Возвращает [(файл, расширение), ...].
+    """
+    ext = EXPORT_FORMATS[fmt][0]
+    rows = export_rows(spools, limit, "%Y-%m-%d %H:%M" if fmt == "jsonl" else "%d.%m.%Y %H:%M")
+    widths = column_widths(spools) if fmt == "excel" else None
+    # Размер xlsx известен только после сохранения — его режем по оценке числа строк
+    per_part = max(1, int(EXPORT_PART_BYTES / (spool_row_bytes(spools) * EXPORT_FORMATS["excel"][2])))
+    parts = []
+    try:
+        while True:
+            first = next(rows, None)
+            if first is None and parts:
+                break
+            out = tempfile.SpooledTemporaryFile(max_size=EXPORT_MEM_BYTES)
+            parts.append((out, ext))
+            chunk = itertools.chain([first] if first else [], rows)
+            if fmt == "excel":
+                write_xlsx(itertools.islice(chunk, per_part), out, widths)
+            else:
+                writer = {"csv": write_csv, "csvgz": write_csv_gz, "zip": write_zip, "jsonl": write_jsonl}[fmt]
+                writer(until_size(chunk, out, EXPORT_PART_BYTES), out)
+            out.seek(0)
+            if first is None:
+                break
+    except BaseException:
+        for out, _ in parts: out.close()
+        raise
+    return parts
+
+async def render_export(spools, fmt: str, limit: Optional[int] = None) -> list:
+    # openpyxl и сжатие — синхронные и тяжёлые: рендерим в пуле потоков, чтобы не блокировать бота
+    loop = asyncio.get_running_loop()
+    with metrics.timer("tgparse_export_seconds", format=fmt):
+        parts = await loop.run_in_executor(export_pool, write_export, spools, fmt, limit)
+    metrics.inc("tgparse_export_bytes_total", sum(out.seek(0, 2) for out, _ in parts), format=fmt)
+    for out, _ in parts: out.seek(0)
+    return parts
+
+def part_name(base: str, ext: str, i: int, total: int) -> str:
+    return f"{base}.{ext}" if total == 1 else f"{base}_part{i}of{total}.{ext}"
+
+# ─── Кэш результатов ──────────────────────────────────────────────────────────
+def result_key(p: dict) -> Optional[str]:
+    """Ключ готовой выгрузки: чаты, период, лимит, ключевые слова и формат.
+
+    Период — кнопка, а не точные даты: «7 дней» сейчас и через пару минут —
+    один запрос, разницу покрывает RESULT_CACHE_TTL. «Сегодня» — ещё и с датой.
+    """
+    if not p.get("period") or p.get("date_to"):
+        return None   # задачи из старой версии и окна с правой границей не кэшируем
+    try:
+        chats = [canonical_chat(c) for c in p["chats"]]
+    except ValueError:
+        return None
+    period = p["period"] + (f":{p['date_from'][:10]}" if p["period"] == "today" else "")
+    keywords = sorted({k.strip().casefold() for k in p.get("keywords") or [] if k.strip()})
+    raw = json.dumps([chats, period, p["limit"], keywords, p["fmt"]], ensure_ascii=False)
+    return hashlib.sha1(raw.encode()).hexdigest()[:24]
+
+class ResultCache:
+    """Готовые выгрузки на диске (RESULT_CACHE_DIR) с LRU-вытеснением по RESULT_CACHE_BYTES.
+
+    Описание записи — в таблице result_cache. После первой отправки у частей
+    есть file_id Telegram: повтор уходит без повторной загрузки файла, даже
+    если сам файл уже стёрт с диска (например, после редеплоя).
+    """
+
+    def __init__(self, path: str, max_bytes: int, ttl: int):
+        self.path, self.max_bytes, self.ttl = path, max_bytes, ttl
+        self._locks = KeyedLocks()
+        self.stats = {"hits": 0, "misses": 0}
+
+    def lock(self, key: Optional[str]) -> AbstractAsyncContextManager:
+        # Одинаковые запросы — по одному: второй дождётся первого и получит готовый файл
+        return self._locks.hold(key) if key else asyncio.Lock()
+
+    async def get(self, key: Optional[str]) -> Optional[dict]:
+        if not key:
+            return None
+        row = await db.fetchone("SELECT * FROM result_cache WHERE key=?", (key,))
+        entry = None
+        if row and time.time() - row["created_at"] <= self.ttl:
+            entry = {**row, "parts": json.loads(row["parts"]), "counts": json.loads(row["counts"])}
+            if not all(file_id or os.path.exists(path) for _, path, file_id in entry["parts"]):
+                entry = None
+        if entry is None:
+            self.stats["misses"] += 1
+            metrics.inc("tgparse_result_cache_total", result="miss")
+            return None
+        self.stats["hits"] += 1
+        metrics.inc("tgparse_result_cache_total", result="hit")
+        db.defer("UPDATE result_cache SET used_at=? WHERE key=?", (int(time.time()), key))
+        return entry
+
+    def _write(self, key: str, documents: list) -> tuple[list, int]:
+        os.makedirs(self.path, exist_ok=True)
+        paths, size = [], 0
+        for i, (out, name) in enumerate(documents, 1):
+            path = os.path.join(self.path, f"{key}_{i}.{name.split('.', 1)[1]}")
+            out.seek(0)
+            with open(path, "wb") as f:
+                shutil.copyfileobj(out, f)
+                size += f.tell()
+            paths.append(path)
+        return paths, size
+
+    async def put(self, key: str, documents: list, file_ids: list, counts: list, msgs: int, users: int):
+        """documents — [(файл, имя)] только что отправленных частей, file_ids — их file_id."""
+        loop = asyncio.get_running_loop()
+        paths, size = await loop.run_in_executor(export_pool, self._write, key, documents)
+        parts = [[name, path, file_id] for (_, name), path, file_id in zip(documents, paths, file_ids)]
+        now = int(time.time())
+        await db.execute(
+            "INSERT OR REPLACE INTO result_cache(key,parts,counts,msgs,users,bytes,created_at,used_at) "
+            "VALUES(?,?,?,?,?,?,?,?)",
+            (key, json.dumps(parts, ensure_ascii=False), json.dumps(counts), msgs, users, size, now, now))
+        await self.evict()
+
+    async def drop(self, key: str):
+        await db.execute("DELETE FROM result_cache WHERE key=?", (key,))
+
+    def set_file_ids(self, key: str, parts: list):
+        db.defer("UPDATE result_cache SET parts=? WHERE key=?", (json.dumps(parts, ensure_ascii=False), key))
+
+    async def evict(self):
+        # Сначала самые свежие по использованию; всё, что за лимитом размера или протухло, — удаляем
+        rows = await db.fetchall("SELECT key, parts, bytes, created_at FROM result_cache ORDER BY used_at DESC")
+        total, drop, now = 0, [], time.time()
+        for row in rows:
+            total += row["bytes"]
+            if total > self.max_bytes or now - row["created_at"] > self.ttl:
+                drop.append(row)
+        if not drop:
+            return
+        def _delete(con):
+            with con:
+                con.executemany("DELETE FROM result_cache WHERE key=?", [(r["key"],) for r in drop])
+        await db.run(_delete)
+        for row in drop:
+            for _, path, _ in json.loads(row["parts"]):
+                try: os.remove(path)
+                except FileNotFoundError: pass
+
+    async def summary(self) -> dict:
+        return await db.fetchone("SELECT COUNT(*) AS entries, COALESCE(SUM(bytes), 0) AS bytes FROM result_cache")
+
+result_cache = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_BYTES, RESULT_CACHE_TTL)
+
+def export_caption(msgs: int, users: int, chats: int, parts: int) -> str:
+    caption = (
+        f"✅ *Готово!*\n\n"
+        f"📊 Сообщений: *{msgs:,}*\n"
+        f"👥 Пользователей: *{users:,}*\n"
+        f"📡 Чатов: *{chats}*"
+    )
+    if parts > 1:
+        caption += f"\n📦 Частей: *{parts}*"
+    return caption
 
 # ─── /start ───────────────────────────────────────────────────────────────────
 async def cmd_start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     u = update.effective_user
     db_upsert_user(u.id, u.username)
-    plan = get_user_plan(u.id)
+    plan = await get_user_plan(u.id)
 
     kb = ReplyKeyboardMarkup([
         [KeyboardButton("▶ Парсить"), KeyboardButton("💳 Тарифы")],
@@ -284,7 +2096,7 @@ async def cmd_start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
 # ─── Тарифы ───────────────────────────────────────────────────────────────────
 async def cmd_plans(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    user_plan = get_user_plan(update.effective_user.id)
+    user_plan = await get_user_plan(update.effective_user.id)
     text = "💳 *Тарифы TGParse PRO*\n\n"
     kb = []
 
@@ -334,8 +2146,8 @@ async def payment_success(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     plan_key = payload.replace("plan_", "")
     plan = PLANS.get(plan_key)
 
-    db_set_plan(user_id, plan_key, days=30)
-    db_add_payment(user_id, plan_key, stars)
+    await db_set_plan(user_id, plan_key, days=30)
+    await db_add_payment(user_id, plan_key, stars)
 
     await update.message.reply_text(
         f"✅ *Оплата прошла успешно!*\n\n"
@@ -349,7 +2161,7 @@ async def payment_success(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 async def cmd_parse(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     db_upsert_user(user_id, update.effective_user.username)
-    plan = get_user_plan(user_id)
+    plan = await get_user_plan(user_id)
     ctx.user_data["plan"] = plan
 
     await update.message.reply_text(
@@ -367,7 +2179,7 @@ async def got_chat(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     plan = ctx.user_data.get("plan", PLANS["free"])
 
     # Несколько чатов через запятую
-    chats = [c.strip() for c in chats_raw.split(",")]
+    chats = [c.strip() for c in chats_raw.split(",") if c.strip()]
     if len(chats) > plan["chat_limit"]:
         await update.message.reply_text(
             f"⚠️ Твой тариф позволяет парсить не более *{plan['chat_limit']} чатов* за раз.\n"
@@ -376,7 +2188,19 @@ async def got_chat(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         )
         return WAIT_CHAT
 
-    ctx.user_data["chats"] = chats
+    # Опечатку видно сразу, а не после выбора периода, лимита и формата
+    # Длинный список — только по кэшу: остальное проверит парсинг, не разом пачкой ResolveUsername
+    network = len(chats) <= CHAT_CHECK_MAX
+    checked = await asyncio.gather(*(chat_resolver.check(c, network) for c in chats))
+    errors = [err for _, err in checked if err]
+    if errors or not chats:
+        await update.message.reply_text(
+            "❌ Не получилось найти:\n" + "\n".join(f"• {e}" for e in errors) +
+            "\n\nПопробуй ещё раз или /cancel" if errors else "Пришли @username или ссылку на чат."
+        )
+        return WAIT_CHAT
+
+    ctx.user_data["chats"] = list(dict.fromkeys(chat for chat, _ in checked))
 
     kb = InlineKeyboardMarkup([
         [InlineKeyboardButton("📅 Сегодня",   callback_data="p_today"),
@@ -414,82 +2238,336 @@ async def got_period(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 async def got_limit(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query; await q.answer()
     ctx.user_data["limit"] = int(q.data.replace("l_", ""))
+    ctx.user_data["keywords"] = None
 
-    kb = InlineKeyboardMarkup([[
-        InlineKeyboardButton("📊 Excel", callback_data="f_excel"),
-        InlineKeyboardButton("📄 CSV",   callback_data="f_csv"),
-    ]])
-    await q.edit_message_text("💾 Выбери формат файла:", reply_markup=kb)
+    kb = InlineKeyboardMarkup([[InlineKeyboardButton("➡️ Без фильтра", callback_data="k_none")]])
+    await q.edit_message_text(
+        "🔎 Ключевые слова через запятую:\n"
+        "`цена, купить` — любое из слов\n"
+        "`\"кот\"` — только целое слово\n"
+        "`-реклама` — исключить\n\n"
+        "Или нажми «Без фильтра».",
+        parse_mode="Markdown", reply_markup=kb,
+    )
+    return WAIT_KEYWORDS
+
+def format_prompt(ctx) -> tuple[str, InlineKeyboardMarkup]:
+    # Оценка сверху — лимит на каждый чат; для больших выгрузок советуем сжатие
+    est = estimate_export_bytes(ctx.user_data["limit"] * len(ctx.user_data["chats"]), "csv")
+    big = est > EXPORT_PART_BYTES // 4
+    text = "💾 Выбери формат файла:"
+    if big:
+        text += (f"\n\n📦 Выгрузка может занять до ~{est / 2**20:.0f} МБ. "
+                 f"CSV.gz и ZIP в 3–4 раза меньше и грузятся быстрее. "
+                 f"Файлы больше {EXPORT_PART_BYTES // 2**20} МБ придут частями.")
+    buttons = [
+        InlineKeyboardButton(("⭐ " if big and fmt in ("csvgz", "zip") else "") + label, callback_data=f"f_{fmt}")
+        for fmt, (_, label, _) in EXPORT_FORMATS.items()
+    ]
+    return text, InlineKeyboardMarkup([buttons[i:i + 2] for i in range(0, len(buttons), 2)])
+
+async def got_keywords(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    matcher = KeywordMatcher.parse(update.message.text)
+    ctx.user_data["keywords"] = matcher.terms if matcher else None
+    text, kb = format_prompt(ctx)
+    await update.message.reply_text(text, reply_markup=kb)
+    return WAIT_FORMAT
+
+async def skip_keywords(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query; await q.answer()
+    ctx.user_data["keywords"] = None
+    text, kb = format_prompt(ctx)
+    await q.edit_message_text(text, reply_markup=kb)
     return WAIT_FORMAT
 
 async def got_format(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query; await q.answer()
-    fmt     = q.data.replace("f_", "")
-    chats   = ctx.user_data["chats"]
-    period  = ctx.user_data["period"]
-    limit   = ctx.user_data["limit"]
     user_id = q.from_user.id
+    plan    = ctx.user_data.get("plan", PLANS["free"])
 
+    now = datetime.now(timezone.utc)
     periods_map = {
-        "today":  (datetime.now(timezone.utc).replace(hour=0,minute=0,second=0), None),
-        "7days":  (datetime.now(timezone.utc)-timedelta(days=7), None),
-        "30days": (datetime.now(timezone.utc)-timedelta(days=30), None),
-        "90days": (datetime.now(timezone.utc)-timedelta(days=90), None),
-        "all":    (None, None),
+        "today":  now.replace(hour=0, minute=0, second=0),
+        "7days":  now - timedelta(days=7),
+        "30days": now - timedelta(days=30),
+        "90days": now - timedelta(days=90),
     }
-    date_from, date_to = periods_map.get(period, (None, None))
-
+    date_from = periods_map.get(ctx.user_data["period"])
+    params = {
+        "chats":     ctx.user_data["chats"],
+        "date_from": date_from.isoformat() if date_from else None,
+        "date_to":   None,
+        "limit":     ctx.user_data["limit"],
+        "keywords":  ctx.user_data.get("keywords"),
+        "fmt":       q.data.replace("f_", ""),
+        "period":    ctx.user_data["period"],   # для ключа кэша результатов
+    }
+    job_id, position = await parse_queue.submit(user_id, q.message.chat_id, plan["priority"], params)
     await q.edit_message_text(
-        f"⚙️ Запускаю парсинг {len(chats)} чат(ов)...\n⏳ Подожди немного.",
+        f"🕐 Задача #{job_id} поставлена в очередь\n"
+        f"Позиция: {position}\n\n"
+        f"Результат придёт сюда. /stop — отменить все свои задачи.",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🛑 Отменить", callback_data=f"jc_{job_id}")]]),
     )
+    return ConversationHandler.END
 
-    all_dfs = []
-    for chat in chats:
-        prog_msg = await q.message.reply_text(f"📡 Парсю `{chat}`...", parse_mode="Markdown")
-
-        async def on_progress(count, _chat=chat, _msg=prog_msg):
-            try: await _msg.edit_text(f"📡 `{_chat}`: собрано {count:,}...", parse_mode="Markdown")
-            except: pass
-
-        try:
-            df = await parse_messages(chat, date_from, date_to, limit, progress_cb=on_progress)
-            all_dfs.append(df)
-            db_log_parse(user_id, chat, len(df))
-            await prog_msg.delete()
-        except Exception as e:
-            await prog_msg.edit_text(f"❌ Ошибка для `{chat}`: {e}", parse_mode="Markdown")
-
-    if not all_dfs:
-        await q.message.reply_text("⚠️ Ничего не найдено.")
-        return ConversationHandler.END
-
-    final_df = pd.concat(all_dfs, ignore_index=True)
-    final_df["№"] = range(1, len(final_df)+1)
-
-    ts = datetime.now().strftime("%Y%m%d_%H%M")
-    if fmt == "excel":
-        data = df_to_excel(final_df)
-        fname = f"tgparse_{ts}.xlsx"
+async def cancel_job(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    # Кнопка под «поставлена в очередь» — отменяет только эту задачу
+    q = update.callback_query
+    job_id = int(q.data.replace("jc_", ""))
+    if await parse_queue.cancel(q.from_user.id, job_id):
+        await q.answer("Отменено")
+        await q.edit_message_text(f"🛑 Задача #{job_id} отменена.")
     else:
-        data = df_to_csv(final_df)
-        fname = f"tgparse_{ts}.csv"
+        await q.answer("Задача уже завершена", show_alert=True)
+        await q.edit_message_reply_markup(None)
+
+async def cmd_stop(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    n = await parse_queue.cancel(update.effective_user.id)
+    await update.message.reply_text(f"🛑 Отменено задач: {n}" if n else "Нет активных задач.")
+
+# ─── Очередь парсинга ────────────────────────────────────────────────────────
+async def send_cached(bot, chat_id: int, key: str, entry: dict) -> bool:
+    """Повтор готовой выгрузки: по file_id без загрузки, файлом с диска — если file_id нет или он не принят.
+
+    False — file_id отклонён, а файла на диске уже нет: запись удалена, нужен обычный парсинг.
+    """
+    age = (time.time() - entry["created_at"]) / 60
+    caption = (export_caption(entry["msgs"], entry["users"], len(entry["counts"]), len(entry["parts"])) +
+               f"\n♻️ Из кэша: собрано {age:.0f} мин назад")
+    parts, changed = entry["parts"], False
+    for i, part in enumerate(parts, 1):
+        filename, path, file_id = part
+        kwargs = dict(filename=filename, caption=caption if i == len(parts) else None, parse_mode="Markdown")
+        msg = None
+        if file_id:
+            try:
+                msg = await bot.send_document(chat_id, document=file_id, **kwargs)
+            except BadRequest as e:
+                log.warning(f"Cached file_id rejected: {e}")
+        if msg is None:
+            try:
+                f = open(path, "rb")
+            except FileNotFoundError:
+                log.warning(f"Result cache entry {key} lost its file, parsing again")
+                await result_cache.drop(key)
+                return False
+            with f:
+                msg = await bot.send_document(chat_id, document=f, **kwargs)
+            part[2], changed = msg.document.file_id if msg.document else None, True
+    if changed:
+        result_cache.set_file_ids(key, parts)
+    return True
+
+@metrics.timed("tgparse_job_seconds")
+async def run_parse_job(app, job: dict):
+    p = job["params"]
+    bot, reply_to, user_id = app.bot, job["chat_id"], job["user_id"]
+    chats, limit = p["chats"], p["limit"]
+    date_from = datetime.fromisoformat(p["date_from"]) if p["date_from"] else None
+    date_to   = datetime.fromisoformat(p["date_to"]) if p["date_to"] else None
+    keywords  = KeywordMatcher(p["keywords"]) if p.get("keywords") else None
+
+    await db_set_job_status(job["id"], "running")
+    spools = []
+    cache_key = result_key(p)
+    try:
+        async with result_cache.lock(cache_key):
+            entry = await result_cache.get(cache_key)
+            if entry and await send_cached(bot, reply_to, cache_key, entry):
+                # Учёт — как за настоящий парсинг: каждому пользователю его строки
+                for chat, count in zip(chats, entry["counts"]):
+                    db_log_parse(user_id, chat, count)
+            else:
+                await bot.send_message(reply_to, f"⚙️ Запускаю парсинг {len(chats)} чат(ов)...\n⏳ Подожди немного.")
+                prog_msgs = [
+                    await bot.send_message(reply_to, f"📡 `{chat}`: в очереди...", parse_mode="Markdown")
+                    for chat in chats
+                ]
+
+                async def parse_one(chat, prog_msg):
+                    progress = ProgressReporter(prog_msg, chat, total=limit)
+
+                    async def on_account(client, limiter):
+                        progress.start()
+                        return await parse_messages(client, chat, date_from, date_to, limit, keywords=keywords,
+                                                    progress_cb=progress.update, limiter=limiter)
+
+                    try:
+                        # Слоты общие для всех пользователей: на аккаунт не больше PARSE_CONCURRENCY чатов
+                        try:
+                            spool = await pool.run(chat, on_account)
+                        finally:
+                            await progress.stop()
+                        db_log_parse(user_id, chat, len(spool))
+                        await prog_msg.delete()
+                        return spool
+                    except Exception as e:
+                        await prog_msg.edit_text(f"❌ Ошибка для `{chat}`: {e}", parse_mode="Markdown")
+                        return None
+
+                # gather сохраняет порядок чатов — итоговая нумерация та же, что при последовательном парсинге
+                results = await asyncio.gather(*(parse_one(c, m) for c, m in zip(chats, prog_msgs)))
+                spools = [spool for spool in results if spool is not None]
+
+                if not spools:
+                    await bot.send_message(reply_to, "⚠️ Ничего не найдено.")
+                else:
+                    ts = datetime.now().strftime("%Y%m%d_%H%M")
+                    parts = await render_export(spools, p["fmt"])
+                    try:
+                        msgs, users = sum(len(s) for s in spools), len(set().union(*(s.users for s in spools)))
+                        caption = export_caption(msgs, users, len(chats), len(parts))
+                        documents = [(out, part_name(f"tgparse_{ts}", ext, i, len(parts)))
+                                     for i, (out, ext) in enumerate(parts, 1)]
+                        # Подпись — у последней части, чтобы «Готово» приходило, когда всё загружено
+                        file_ids = []
+                        for i, (out, filename) in enumerate(documents, 1):
+                            msg = await bot.send_document(
+                                reply_to, document=out, filename=filename,
+                                caption=caption if i == len(parts) else None, parse_mode="Markdown",
+                            )
+                            file_ids.append(msg.document.file_id if msg.document else None)
+                        # Кэшируем только полный результат: упавший чат при повторе стоит попробовать снова
+                        if cache_key and len(spools) == len(chats):
+                            try:
+                                await result_cache.put(cache_key, documents, file_ids, [len(s) for s in spools], msgs, users)
+                            except OSError as e:
+                                log.warning(f"Result cache write failed: {e}")
+                    finally:
+                        for out, _ in parts: out.close()
+        await db_set_job_status(job["id"], "done")
+    except asyncio.CancelledError:
+        if job.get("cancelled"):
+            await db_set_job_status(job["id"], "cancelled")
+            await bot.send_message(reply_to, f"🛑 Задача #{job['id']} отменена.")
+        # Иначе бот останавливается: статус остаётся running, после рестарта задача вернётся в очередь
+        raise
+    except Exception as e:
+        log.error(f"Job #{job['id']} failed: {e}")
+        await db_set_job_status(job["id"], "failed")
+        await bot.send_message(reply_to, f"❌ Задача #{job['id']} не выполнена: {e}")
+    finally:
+        for spool in spools: spool.close()
+
+class ParseQueue:
+    """Очередь задач /parse с фиксированным пулом воркеров.
+
+    Задачи хранятся в таблице jobs и после рестарта возвращаются в очередь.
+    Старший тариф всегда идёт первым, а внутри тарифа пользователи
+    обслуживаются по кругу — по одной задаче за раз, чтобы один пользователь
+    с десятком задач не занимал всех воркеров.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._tiers: dict[int, OrderedDict] = {}       # priority → user_id → deque[job]
+        self._running: dict[int, tuple[dict, asyncio.Task]] = {}
+        self._ready = asyncio.Event()
+        self._tasks: list[asyncio.Task] = []
+
+    def _push(self, job: dict):
+        tier = self._tiers.setdefault(job["priority"], OrderedDict())
+        tier.setdefault(job["user_id"], deque()).append(job)
+        self._ready.set()
+
+    def _pop(self) -> Optional[dict]:
+        for prio in sorted(self._tiers, reverse=True):
+            tier = self._tiers[prio]
+            if not tier:
+                continue
+            user_id, jobs = tier.popitem(last=False)
+            job = jobs.popleft()
+            if jobs:
+                tier[user_id] = jobs   # остальные задачи пользователя — в конец круга
+            return job
+        return None
+
+    def order(self) -> list[int]:
+        # Порядок, в котором воркеры возьмут задачи, если ничего не добавится
+        out = []
+        for prio in sorted(self._tiers, reverse=True):
+            queues = [list(jobs) for jobs in self._tiers[prio].values()]
+            for i in range(max(map(len, queues), default=0)):
+                out.extend(q[i]["id"] for q in queues if i < len(q))
+        return out
+
+    def __len__(self):
+        return sum(len(jobs) for tier in self._tiers.values() for jobs in tier.values())
+
+    @property
+    def running(self) -> int:
+        return len(self._running)
+
+    async def submit(self, user_id: int, chat_id: int, priority: int, params: dict) -> tuple[int, int]:
+        job_id = await db_add_job(user_id, chat_id, priority, params)
+        self._push({"id": job_id, "user_id": user_id, "chat_id": chat_id,
+                    "priority": priority, "params": params})
+        return job_id, self.order().index(job_id) + 1
+
+    async def cancel(self, user_id: int, job_id: Optional[int] = None) -> int:
+        """Отменяет задачи пользователя — все или только job_id. Возвращает, сколько отменено."""
+        queued = []
+        for tier in self._tiers.values():
+            jobs = tier.get(user_id)
+            if not jobs:
+                continue
+            drop = [j for j in jobs if job_id is None or j["id"] == job_id]
+            for job in drop:
+                jobs.remove(job)
+            if not jobs:
+                del tier[user_id]
+            queued.extend(j["id"] for j in drop)
+        if queued:
+            await db_set_jobs_cancelled(queued)
+        running = [(job, task) for job, task in self._running.values()
+                   if job["user_id"] == user_id and job_id in (None, job["id"])]
+        for job, task in running:
+            job["cancelled"] = True
+            task.cancel()
+        return len(queued) + len(running)
+
+    async def start(self, app):
+        # Незавершённые задачи прошлого запуска — снова в очередь
+        for job in await db_get_pending_jobs():
+            if job["status"] == "running":
+                await db_set_job_status(job["id"], "queued")
+                try:
+                    await app.bot.send_message(job["chat_id"], f"🔄 Бот перезапущен — задача #{job['id']} снова в очереди.")
+                except TelegramError as e:
+                    log.warning(f"Job #{job['id']} notify failed: {e}")
+            self._push(job)
+        self._tasks = [asyncio.create_task(self._worker(app)) for _ in range(self.workers)]
+
+    async def stop(self):
+        tasks = self._tasks + [task for _, task in self._running.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _worker(self, app):
+        while True:
+            job = self._pop()
+            if job is None:
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+            task = asyncio.create_task(run_parse_job(app, job))
+            self._running[job["id"]] = (job, task)
+            try:
+                # wait, а не await task: отмена задачи пользователем не должна останавливать воркер
+                await asyncio.wait({task})
+            finally:
+                self._running.pop(job["id"], None)
 
-    caption = (
-        f"✅ *Готово!*\n\n"
-        f"📊 Сообщений: *{len(final_df):,}*\n"
-        f"👥 Пользователей: *{final_df['Пользователь'].nunique():,}*\n"
-        f"📡 Чатов: *{len(chats)}*"
-    )
-    await q.message.reply_document(
-        document=io.BytesIO(data), filename=fname,
-        caption=caption, parse_mode="Markdown",
-    )
-    return ConversationHandler.END
+parse_queue = ParseQueue(JOB_WORKERS)
+metrics.gauge("tgparse_queue_depth", lambda: len(parse_queue), help="задач /parse в очереди")
+metrics.gauge("tgparse_jobs_running", lambda: parse_queue.running)
 
 # ─── Расписание ───────────────────────────────────────────────────────────────
 async def cmd_schedule(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    plan = get_user_plan(user_id)
+    plan = await get_user_plan(user_id)
 
     if not plan["scheduler"]:
         await update.message.reply_text(
@@ -508,7 +2586,12 @@ async def cmd_schedule(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     return WAIT_SCHEDULE_CHAT
 
 async def got_schedule_chat(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    ctx.user_data["sched_chat"] = update.message.text.strip()
+    # Расписания одного чата склеиваются в один парсинг — храним его в каноническом виде
+    chat, error = await chat_resolver.check(update.message.text)
+    if error:
+        await update.message.reply_text(f"❌ Не получилось найти {error}\n\nПопробуй ещё раз или /cancel")
+        return WAIT_SCHEDULE_CHAT
+    ctx.user_data["sched_chat"] = chat
     kb = InlineKeyboardMarkup([
         [InlineKeyboardButton("Каждые 6 часов",  callback_data="si_6"),
          InlineKeyboardButton("Каждые 12 часов", callback_data="si_12")],
@@ -524,7 +2607,8 @@ async def got_schedule_interval(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     chat = ctx.user_data["sched_chat"]
     user_id = q.from_user.id
 
-    db_add_schedule(user_id, chat, interval)
+    await db_add_schedule(user_id, chat, interval)
+    schedule_engine.wake()
     await q.edit_message_text(
         f"✅ *Расписание добавлено!*\n\n"
         f"📡 Чат: `{chat}`\n"
@@ -537,13 +2621,14 @@ async def got_schedule_interval(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 # ─── Мой аккаунт ─────────────────────────────────────────────────────────────
 async def cmd_account(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    u = db_get_user(user_id)
-    plan = get_user_plan(user_id)
+    u = await db_get_user(user_id)
+    plan = await get_user_plan(user_id)
     until = u.get("plan_until", "—")
     if until and until != "—":
         until = datetime.fromisoformat(until).strftime("%d.%m.%Y")
 
-    schedules = [s for s in db_get_schedules() if s["user_id"] == user_id]
+    schedules = await db_get_user_schedules(user_id)
+    recent = await db_get_user_activity(user_id)
 
     text = (
         f"📊 *Мой аккаунт*\n\n"
@@ -551,7 +2636,8 @@ async def cmd_account(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         f"Действует до: *{until}*\n"
         f"Лимит: *{plan['msg_limit']:,} сообщений*\n"
         f"Чатов: *{plan['chat_limit']}*\n"
-        f"Всего спарсено: *{u.get('msgs_used', 0):,}*\n\n"
+        f"Всего спарсено: *{u.get('msgs_used', 0):,}*\n"
+        f"За 30 дней: *{recent['msgs']:,}* в {recent['parses']:,} парсингах\n\n"
     )
     if schedules:
         text += f"⏰ *Расписаний: {len(schedules)}*\n"
@@ -572,52 +2658,205 @@ async def go_plans(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 async def cmd_admin(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID:
         return
-    s = db_stats()
+    if ctx.args and ctx.args[0] == "metrics":
+        # /admin metrics — то же, что отдаёт METRICS_PORT, но коротко
+        summary = metrics.summary() or "пока пусто"
+        await update.message.reply_text(f"📟 Метрики\n\n{summary[:3900]}")
+        return
+    s = await db_stats()
+    days = await db_daily_stats(7)
+    rc = await result_cache.summary()
+    trend = "".join(
+        f"`{datetime.fromisoformat(d['day']).strftime('%d.%m')}` "
+        f"🔄 {d['parses']:,} · 📨 {d['msgs']:,} · ⭐ {d['revenue']:,}\n"
+        for d in days
+    )
     await update.message.reply_text(
         f"📈 *Статистика TGParse PRO*\n\n"
-        f"👥 Пользователей: *{s['users']:,}*\n"
-        f"💳 Платных: *{s['paid']:,}*\n"
-        f"⭐ Доход (Stars): *{s['revenue']:,}*\n"
-        f"🔄 Парсингов: *{s['parses']:,}*\n"
-        f"📨 Сообщений: *{s['msgs']:,}*",
+        f"👥 Пользователей: *{s.get('users', 0):,}*\n"
+        f"💳 Платных: *{s.get('paid', 0):,}*\n"
+        f"⭐ Доход (Stars): *{s.get('revenue', 0):,}*\n"
+        f"🔄 Парсингов: *{s.get('parses', 0):,}*\n"
+        f"📨 Сообщений: *{s.get('msgs', 0):,}*\n\n"
+        + (f"📅 *По дням:*\n{trend}\n" if trend else "") +
+        f"🔌 *Аккаунты:*\n{pool.status()}\n\n"
+        f"🎫 Кэш тарифов: {plan_cache.hits:,} попаданий / {plan_cache.misses:,} промахов\n"
+        f"♻️ Кэш результатов: {rc['entries']:,} выгрузок, {rc['bytes'] / 1024 / 1024:.1f} МБ, "
+        f"{result_cache.stats['hits']:,} повторов / {result_cache.stats['misses']:,} промахов\n"
+        f"🗄 БД: {db.stats['calls']:,} запросов, "
+        f"в среднем {db.stats['time'] / max(db.stats['calls'], 1) * 1000:.2f} мс, "
+        f"{db.stats['batched']:,} записей в {db.stats['batches']:,} пачках",
         parse_mode="Markdown",
     )
 
 # ─── Автопарсинг (scheduler) ─────────────────────────────────────────────────
-async def run_scheduled_parses(app):
-    schedules = db_get_schedules(active_only=True)
-    now = datetime.now(timezone.utc)
-
-    for s in schedules:
-        last = s.get("last_run")
-        if last:
-            last_dt = datetime.fromisoformat(last).replace(tzinfo=timezone.utc)
-            if (now - last_dt).total_seconds() < s["interval_h"] * 3600:
-                continue
+@metrics.timed("tgparse_schedule_group_seconds")
+async def run_schedule_group(app, subs: list, interval_h: int, now: datetime):
+    # Все подписчики одного чата с одинаковым окном получают результат одного парсинга
+    chat = subs[0]["chat"]
+    limits = {s["id"]: (await get_user_plan(s["user_id"]))["msg_limit"] for s in subs}
+    try:
+        async with schedule_slots:
+            spool = await pool.run(chat, lambda client, limiter: parse_messages(
+                client, chat, now - timedelta(hours=interval_h), now, max(limits.values()), limiter=limiter))
+    except Exception as e:
+        log.error(f"Scheduler error for {chat}: {e}")
+        return
 
-        plan = get_user_plan(s["user_id"])
+    done, file_ids = [], {}   # кол-во строк → [(file_id, имя)] уже загруженных частей
+    ts = now.strftime("%Y%m%d_%H%M")
+    try:
+        for s in subs:
+            count = min(len(spool), limits[s["id"]])
+            if count:
+                parts = []
+                try:
+                    documents = file_ids.get(count)
+                    if documents is None:
+                        # Большие автовыгрузки — сжатым CSV, Excel такого размера грузится слишком долго
+                        fmt = "excel"
+                        if estimate_export_bytes(count, "excel", spool_row_bytes([spool])) > EXPORT_PART_BYTES // 4:
+                            fmt = "zip"
+                        parts = await render_export([spool], fmt, limit=count)
+                        documents = [(out, part_name(f"auto_{ts}", ext, i, len(parts)))
+                                     for i, (out, ext) in enumerate(parts, 1)]
+                    sent = []
+                    for i, (document, filename) in enumerate(documents, 1):
+                        msg = await app.bot.send_document(
+                            chat_id=s["user_id"],
+                            document=document,
+                            filename=filename,
+                            caption=f"⏰ *Автопарсинг* `{s['chat']}`\n📊 {count:,} сообщений"
+                                    if i == len(documents) else None,
+                            parse_mode="Markdown",
+                        )
+                        sent.append((msg.document.file_id, filename))
+                    file_ids[count] = sent
+                    db_log_parse(s["user_id"], s["chat"], count)
+                except Exception as e:
+                    log.error(f"Scheduler send error for {s['chat']} → {s['user_id']}: {e}")
+                    continue
+                finally:
+                    for out, _ in parts: out.close()
+            done.append(s["id"])
+    finally:
+        spool.close()
+    if done:
+        await db_update_schedules(done, now + timedelta(hours=interval_h), last_run=now)
+
+async def run_scheduled_parses(app, tasks: set, inflight: set):
+    now = datetime.now(timezone.utc)
+    # Группа может дольше аренды ждать слот в schedule_slots — такие расписания не берём второй раз
+    due = [s for s in await db_get_due_schedules(now) if s["id"] not in inflight]
+    if not due:
+        return
+    # Сразу отодвигаем next_run: если процесс упадёт посреди группы,
+    # она повторится через SCHEDULE_RETRY_MIN
+    await db_update_schedules([s["id"] for s in due], now + timedelta(minutes=SCHEDULE_RETRY_MIN))
+
+    groups: dict[tuple, list] = {}
+    for s in due:
+        groups.setdefault((s["chat"].strip().lower(), s["interval_h"]), []).append(s)
+    for (_, interval_h), subs in groups.items():
+        ids = {s["id"] for s in subs}
+        inflight.update(ids)
+        task = asyncio.create_task(run_schedule_group(app, subs, interval_h, now))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        task.add_done_callback(lambda _, ids=ids: schedule_done(inflight, ids))
+
+def schedule_done(inflight: set, ids: set):
+    # next_run этих расписаний в расчёт сна не входил — пусть движок пересчитает
+    inflight.difference_update(ids)
+    schedule_engine.wake()
+
+class ScheduleEngine:
+    """Спит до ближайшего next_run вместо опроса раз в 30 минут; новое расписание будит сразу."""
+
+    def __init__(self):
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._groups: set = set()
+        self._inflight: set[int] = set()   # id расписаний, чьи группы ещё работают
+
+    def wake(self):
+        self._wake.set()
+
+    def start(self, app):
+        self._task = asyncio.create_task(self._loop(app))
+
+    async def stop(self):
+        tasks = [task for task in [self._task, *self._groups] if task]
+        for task in tasks:
+            task.cancel()
+        # Группы дописывают next_run в базу — дожидаемся их до закрытия db
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+
+    async def _loop(self, app):
+        while True:
+            self._wake.clear()
+            try:
+                await run_scheduled_parses(app, self._groups, self._inflight)
+                nxt = await db_next_schedule_run(exclude=self._inflight)
+                delay = 3600 if nxt is None else (nxt - datetime.now(timezone.utc)).total_seconds()
+            except Exception as e:
+                log.error(f"Scheduler error: {e}")
+                delay = 60
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=min(delay, 3600))
+                except asyncio.TimeoutError:
+                    pass
+
+schedule_slots = asyncio.Semaphore(SCHEDULE_CONCURRENCY)
+schedule_engine = ScheduleEngine()
+metrics.gauge("tgparse_schedule_groups_running", lambda: len(schedule_engine._groups))
+
+# ─── Приём обновлений ────────────────────────────────────────────────────────
+class PerUserUpdates(BaseUpdateProcessor):
+    """Параллельная обработка обновлений, но по очереди в пределах пользователя.
+
+    ConversationHandler рассчитан на последовательные обновления: два сообщения
+    одного пользователя, обработанные вперемешку, сломают шаг диалога. Поэтому
+    сначала берётся замок пользователя и только потом свой слот — ожидающий
+    своей очереди пользователь не занимает слоты остальных. Лимит базового
+    класса берётся заведомо большим: его слот занимается раньше замка.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max(max_concurrent_updates * 64, 1024))
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._locks: dict[int, list] = {}   # user_id → [замок, сколько обновлений его ждут]
+
+    async def do_process_update(self, update, coroutine):
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            async with self._slots:
+                await coroutine
+            return
+        entry = self._locks.setdefault(user.id, [asyncio.Lock(), 0])
+        entry[1] += 1
         try:
-            df = await parse_messages(s["chat"], now - timedelta(hours=s["interval_h"]), now, plan["msg_limit"])
-            if df.empty: continue
-
-            db_log_parse(s["user_id"], s["chat"], len(df))
-            data = df_to_excel(df)
-            ts = now.strftime("%Y%m%d_%H%M")
-
-            await app.bot.send_document(
-                chat_id=s["user_id"],
-                document=io.BytesIO(data),
-                filename=f"auto_{ts}.xlsx",
-                caption=f"⏰ *Автопарсинг* `{s['chat']}`\n📊 {len(df):,} сообщений",
-                parse_mode="Markdown",
-            )
-
-            con = sqlite3.connect(DB)
-            con.execute("UPDATE schedules SET last_run=? WHERE id=?", (now.isoformat(), s["id"]))
-            con.commit(); con.close()
-
-        except Exception as e:
-            log.error(f"Scheduler error for {s['chat']}: {e}")
+            async with entry[0], self._slots:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[user.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+def webhook_url() -> str:
+    base = WEBHOOK_URL or (f"https://{os.environ['RAILWAY_PUBLIC_DOMAIN']}"
+                           if os.getenv("RAILWAY_PUBLIC_DOMAIN") else "")
+    if not base:
+        raise SystemExit("❌ BOT_MODE=webhook: задай WEBHOOK_URL (публичный https-адрес бота)")
+    return f"{base.rstrip('/')}/{WEBHOOK_PATH}"
 
 # ─── Запуск ───────────────────────────────────────────────────────────────────
 def main():
@@ -625,7 +2864,15 @@ def main():
         print("❌ TG_BOT_TOKEN не задан в .env"); return
 
     db_init()
-    app = Application.builder().token(BOT_TOKEN).build()
+    if BOT_MODE not in ("polling", "webhook"):
+        print(f"❌ BOT_MODE={BOT_MODE}: допустимо polling или webhook"); return
+    app = (
+        Application.builder().token(BOT_TOKEN)
+        .base_url(f"{BOT_API_URL}/bot").base_file_url(f"{BOT_API_URL}/file/bot")
+        .request(TimedRequest(connection_pool_size=256))
+        .concurrent_updates(PerUserUpdates(UPDATE_CONCURRENCY))
+        .build()
+    )
 
     # Диалог парсинга
     parse_conv = ConversationHandler(
@@ -637,6 +2884,8 @@ def main():
             WAIT_CHAT:   [MessageHandler(filters.TEXT & ~filters.COMMAND, got_chat)],
             WAIT_PERIOD: [CallbackQueryHandler(got_period, pattern="^p_")],
             WAIT_LIMIT:  [CallbackQueryHandler(got_limit,  pattern="^l_")],
+            WAIT_KEYWORDS: [MessageHandler(filters.TEXT & ~filters.COMMAND, got_keywords),
+                            CallbackQueryHandler(skip_keywords, pattern="^k_none$")],
             WAIT_FORMAT: [CallbackQueryHandler(got_format, pattern="^f_")],
         },
         fallbacks=[CommandHandler("cancel", lambda u,c: ConversationHandler.END)],
@@ -661,6 +2910,8 @@ def main():
     app.add_handler(CommandHandler("admin",   cmd_admin))
     app.add_handler(parse_conv)
     app.add_handler(sched_conv)
+    app.add_handler(CommandHandler("stop",    cmd_stop))
+    app.add_handler(CallbackQueryHandler(cancel_job,  pattern="^jc_"))
     app.add_handler(CallbackQueryHandler(handle_buy,  pattern="^buy_"))
     app.add_handler(CallbackQueryHandler(go_plans,    pattern="^go_plans$"))
     app.add_handler(PreCheckoutQueryHandler(pre_checkout))
@@ -668,18 +2919,51 @@ def main():
     app.add_handler(MessageHandler(filters.Regex("^💳 Тарифы$"),     cmd_plans))
     app.add_handler(MessageHandler(filters.Regex("^📊 Мой аккаунт$"), cmd_account))
 
-    # Планировщик автопарсинга — запускается внутри event loop
-    scheduler = AsyncIOScheduler()
-    scheduler.add_job(run_scheduled_parses, "interval", minutes=30, args=[app])
+    background: dict[str, asyncio.Task] = {}
+    servers: list[asyncio.Server] = []
 
     async def on_startup(application):
-        scheduler.start()
+        db.start()
+        background["housekeeping"] = asyncio.create_task(housekeeping_loop())
+        background["loop_lag"] = asyncio.create_task(loop_lag_monitor())
+        if METRICS_PORT:
+            servers.append(await serve_metrics(METRICS_HOST, METRICS_PORT))
+        await pool.start()
+        # Планировщик автопарсинга — запускается внутри event loop
+        schedule_engine.start(application)
         print("⏰ Планировщик запущен!")
+        await parse_queue.start(application)
 
-    app.post_init = on_startup
+    async def on_stop(application):
+        # post_stop: бот и база ещё открыты — отменённые задачи и группы
+        # расписаний успевают завершиться до их закрытия в post_shutdown
+        for task in background.values(): task.cancel()
+        for server in servers: server.close()
+        await schedule_engine.stop()
+        await parse_queue.stop()
+
+    async def on_shutdown(application):
+        await pool.stop()
+        export_pool.shutdown(wait=True)
+        await db.close()
 
-    print("🚀 TGParse PRO запущен!")
-    app.run_polling(drop_pending_updates=True)
+    app.post_init = on_startup
+    app.post_stop = on_stop
+    app.post_shutdown = on_shutdown
+
+    print(f"🚀 TGParse PRO запущен ({BOT_MODE})!")
+    if BOT_MODE == "webhook":
+        # Очередь обновлений у Telegram не сбрасываем: оплаты, пришедшие во время
+        # рестарта, доставятся после него. При остановке сервер перестаёт принимать
+        # запросы, а уже принятые обновления дорабатываются до закрытия бота
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, url_path=WEBHOOK_PATH,
+            webhook_url=webhook_url(), secret_token=WEBHOOK_SECRET or secrets.token_urlsafe(32),
+            max_connections=WEBHOOK_MAX_CONNECTIONS, allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=False,
+        )
+    else:
+        app.run_polling(drop_pending_updates=True)
 
 if __name__ == "__main__":
     main()